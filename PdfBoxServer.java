@@ -0,0 +1,65 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.io.StringWriter;
+import java.nio.charset.StandardCharsets;
+
+import org.apache.pdfbox.pdmodel.PDDocument;
+import org.apache.pdfbox.pdmodel.encryption.AccessPermission;
+import org.apache.pdfbox.text.PDFTextStripper;
+import org.apache.pdfbox.tools.PDFText2HTML;
+
+/**
+ * Long lived version of `java -jar pdfbox-app-2.0.7.jar ExtractText -html -console <pdf>`
+ * used by pdfbox_daemon.py
+ *
+ * Writes "READY" when it has started. Then reads one PDF path per line from stdin. For each path writes a header line "OK <n>" or "ERR <n>"
+ * to stdout followed by <n> bytes of UTF-8: the HTML text of the PDF or an error message.
+ */
+public class PdfBoxServer {
+
+    public static void main(String[] args) throws IOException {
+        // Keep anything PDFBox prints off the protocol stream.
+        OutputStream out = new PrintStream(System.out, false, "UTF-8");
+        System.setOut(System.err);
+
+        out.write("READY\n".getBytes(StandardCharsets.US_ASCII));
+        out.flush();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String path;
+        while ((path = in.readLine()) != null) {
+            String status = "OK";
+            byte[] body;
+            try {
+                body = extractText(path).getBytes(StandardCharsets.UTF_8);
+            } catch (Exception e) {
+                status = "ERR";
+                body = String.valueOf(e).getBytes(StandardCharsets.UTF_8);
+            }
+            String header = status + " " + body.length + "\n";
+            out.write(header.getBytes(StandardCharsets.US_ASCII));
+            out.write(body);
+            out.flush();
+        }
+    }
+
+    /** Same settings as ExtractText -html with default options. */
+    static String extractText(String path) throws IOException {
+        try (PDDocument document = PDDocument.load(new File(path), "")) {
+            AccessPermission ap = document.getCurrentAccessPermission();
+            if (!ap.canExtractContent()) {
+                throw new IOException("You do not have permission to extract text");
+            }
+            PDFTextStripper stripper = new PDFText2HTML();
+            stripper.setSortByPosition(false);
+            stripper.setShouldSeparateByBeads(true);
+            StringWriter writer = new StringWriter();
+            stripper.writeText(document, writer);
+            return writer.toString();
+        }
+    }
+}
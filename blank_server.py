@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+"""
+    HTTP service that finds the blank pages in PDFs
+
+    The PDFs are analyzed with the make_page_corpus.py extraction and the detect_blank_pages.py
+    empty and watermark page logic in a pool of worker processes.
+
+    Usage::
+        ./blank_server.py [<port>]
+
+    Classify one PDF::
+        curl --data-binary @doc.pdf -H 'Content-Type: application/pdf' http://localhost:8001/blank
+
+    Classify a batch. Each document has base64 'data' or the 'path' of a PDF under pdf_dir::
+        curl -d '{"documents": [{"name": "a.pdf", "data": "JVBERi0..."}, {"path": "b.pdf"}]}' \\
+            -H 'Content-Type: application/json' http://localhost:8001/blank
+
+    Server status::
+        curl http://localhost:8001/status
+
+    Responses are json. Each document's result has 'blank_pages' (page indexes starting at 0),
+    'empty_pages', 'watermark_pages' and 'watermark', or 'error'. Requests that would take the
+    number of documents waiting or being analyzed over `max_queue` get a 503.
+    Timing headers:
+        X-Queue-Time: ms the slowest document waited for a worker
+        X-Process-Time: ms from receiving the request to sending the response
+        Server-Timing: queue, extract, detect and total durations in ms
+"""
+import os
+import io
+import json
+import time
+import base64
+import tempfile
+import threading
+from functools import partial
+from shutil import rmtree
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils_peter import pdf_dir
+from make_page_corpus import pdf_to_summary
+from detect_blank_pages import find_no_text_pages, find_watermark_pages, add_lists
+
+
+# Settings
+port = 8001
+n_workers = os.cpu_count() or 1  # Processes analyzing PDFs
+max_queue = 4 * n_workers        # Documents waiting or being analyzed before requests get a 503
+max_batch = 100                  # Documents in one request. Batches are also limited to max_queue
+max_body = 500 * 1024 * 1024     # Bytes in one request
+request_timeout = 15 * 60        # Seconds a request waits for its results
+min_len = 5                      # find_watermark_pages arguments
+max_len = 200
+allowed_roots = [pdf_dir]        # Directories that batch 'path' entries may be read from
+
+
+def classify_pdf(pdf_path, submitted):
+    """Find the blank pages in PDF file `pdf_path`. Runs in a worker process.
+        `submitted` is the time.time() the request was queued.
+        Returns: result dict
+    """
+    t0 = time.time()
+    result = {}
+    log = io.StringIO()
+    with redirect_stdout(log):
+        try:
+            summary = pdf_to_summary(pdf_path)
+        except Exception as e:
+            summary = None
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+    t1 = time.time()
+    if summary is None:
+        result.setdefault('error', 'extraction failed')
+    else:
+        try:
+            page_texts = summary['page_texts']
+            indexes_empty = find_no_text_pages(page_texts)
+            indexes_watermark, text_watermark = find_watermark_pages(page_texts, min_len, max_len)
+            result.update({
+                'n_pages': len(page_texts),
+                'blank_pages': add_lists(indexes_empty, indexes_watermark),
+                'empty_pages': indexes_empty,
+                'watermark_pages': indexes_watermark,
+                'watermark': text_watermark,
+            })
+        except Exception as e:
+            result['error'] = 'detection failed: %s: %s' % (type(e).__name__, e)
+    t2 = time.time()
+    result['timing'] = {
+        'queue': 1000.0 * (t0 - submitted),
+        'extract': 1000.0 * (t1 - t0),
+        'detect': 1000.0 * (t2 - t1),
+    }
+    return result
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def allowed_path(path):
+    """Returns: absolute path of batch entry `path` if it is a file under one of `allowed_roots`"""
+    for root in allowed_roots:
+        full = os.path.realpath(os.path.join(root, path))
+        if full.startswith(os.path.join(os.path.realpath(root), '')) and os.path.isfile(full):
+            return full
+    raise HTTPError(403, 'path not allowed: %s' % path)
+
+
+class BlankService:
+    """The worker pool and the limit on the number of queued documents"""
+
+    def __init__(self, n_workers, max_queue):
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=n_workers)
+        self.n_queued = 0
+        self.n_docs = 0
+        self.n_rejected = 0
+
+    def reserve(self, n):
+        """Reserve `n` queue slots without waiting
+            Returns: True if they were reserved
+        """
+        for i in range(n):
+            if not self.slots.acquire(blocking=False):
+                for _ in range(i):
+                    self.slots.release()
+                with self.lock:
+                    self.n_rejected += 1
+                return False
+        with self.lock:
+            self.n_queued += n
+        return True
+
+    def release(self, n):
+        for _ in range(n):
+            self.slots.release()
+        with self.lock:
+            self.n_queued -= n
+            self.n_docs += n
+
+    def classify(self, pdf_paths, on_done):
+        """Classify the PDFs in `pdf_paths` in the worker pool. `on_done`() is called once the
+            workers have finished with all the PDFs. After a timeout that is after this returns.
+            Returns: list of result dicts
+        """
+        submitted = time.time()
+        executor = self.executor
+        futures = []
+        try:
+            for path in pdf_paths:
+                futures.append(executor.submit(classify_pdf, path, submitted))
+            deadline = time.time() + request_timeout
+            return [future.result(timeout=max(deadline - time.time(), 0)) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise HTTPError(504, 'timed out after %d sec' % request_timeout)
+        except BrokenProcessPool:
+            # A worker died. Replace the pool so that later requests can be served
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = ProcessPoolExecutor(max_workers=self.n_workers)
+            raise HTTPError(500, 'worker process failed')
+        finally:
+            when_all_done(futures, on_done)
+
+    def status(self):
+        with self.lock:
+            return {
+                'n_workers': self.n_workers,
+                'max_queue': self.max_queue,
+                'queued': self.n_queued,
+                'docs': self.n_docs,
+                'rejected': self.n_rejected,
+            }
+
+
+def when_all_done(futures, on_done):
+    """Call `on_done`() once all of `futures` are done"""
+    lock = threading.Lock()
+    remaining = [len(futures)]
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            on_done()
+
+    if not futures:
+        on_done()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class BlankHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self.send_json(200, self.service.status())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        t0 = time.perf_counter()
+        temp_dir = None
+        try:
+            if self.path.rstrip('/') != '/blank':
+                raise HTTPError(404, 'not found')
+            length = self.headers.get('Content-Length')
+            if length is None:
+                raise HTTPError(411, 'no Content-Length')
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise HTTPError(400, 'bad Content-Length')
+            if length > max_body:
+                raise HTTPError(413, 'request is larger than %d bytes' % max_body)
+            body = self.rfile.read(length)
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+            temp_dir = tempfile.mkdtemp(prefix='blank_server.')
+            if content_type == 'application/json':
+                batch = True
+                names, pdf_paths = self.read_batch(body, temp_dir)
+            else:
+                batch = False
+                names = [None]
+                pdf_paths = [save_pdf(os.path.join(temp_dir, '0.pdf'), body)]
+            if not self.service.reserve(len(pdf_paths)):
+                raise HTTPError(503, 'server busy')
+            # The slots and the PDFs are released when the workers are finished with them, which
+            # can be after the response if the request times out
+            done = partial(finish_request, self.service, len(pdf_paths), temp_dir)
+            temp_dir = None
+            results = self.service.classify(pdf_paths, done)
+        except HTTPError as e:
+            headers = {'Retry-After': '1'} if e.status == 503 else None
+            self.send_json(e.status, {'error': str(e)}, headers)
+            return
+        finally:
+            if temp_dir:
+                rmtree(temp_dir, ignore_errors=True)
+
+        for name, result in zip(names, results):
+            if name is not None:
+                result['name'] = name
+        total = 1000.0 * (time.perf_counter() - t0)
+        queue = max(r['timing']['queue'] for r in results)
+        extract = sum(r['timing']['extract'] for r in results)
+        detect = sum(r['timing']['detect'] for r in results)
+        headers = {
+            'X-Queue-Time': '%.1f' % queue,
+            'X-Process-Time': '%.1f' % total,
+            'Server-Timing': 'queue;dur=%.1f, extract;dur=%.1f, detect;dur=%.1f, total;dur=%.1f' % (
+                             queue, extract, detect, total),
+        }
+        self.send_json(200, {'documents': results} if batch else results[0], headers)
+
+    def read_batch(self, body, temp_dir):
+        """Returns: names and local paths of the PDFs in json batch `body`"""
+        try:
+            documents = json.loads(body.decode('utf-8'))['documents']
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, 'bad batch: %s' % e)
+        if not isinstance(documents, list) or not documents:
+            raise HTTPError(400, 'bad batch: no documents')
+        # A batch larger than max_queue could never be queued, so it is rejected here rather than
+        # getting a 503 on every retry
+        limit = min(max_batch, self.service.max_queue)
+        if len(documents) > limit:
+            raise HTTPError(413, 'batch has more than %d documents' % limit)
+        names = []
+        pdf_paths = []
+        for i, doc in enumerate(documents):
+            if not isinstance(doc, dict):
+                raise HTTPError(400, 'bad batch: document %d' % i)
+            if 'data' in doc:
+                try:
+                    data = base64.b64decode(doc['data'], validate=True)
+                except (ValueError, TypeError) as e:
+                    raise HTTPError(400, 'bad batch: document %d: %s' % (i, e))
+                pdf_paths.append(save_pdf(os.path.join(temp_dir, '%d.pdf' % i), data))
+            elif 'path' in doc:
+                pdf_paths.append(allowed_path(doc['path']))
+            else:
+                raise HTTPError(400, 'bad batch: document %d has no data or path' % i)
+            names.append(doc.get('name', doc.get('path', str(i))))
+        return names, pdf_paths
+
+
+def finish_request(service, n, temp_dir):
+    service.release(n)
+    rmtree(temp_dir, ignore_errors=True)
+
+
+def save_pdf(path, data):
+    if not data.startswith(b'%PDF'):
+        raise HTTPError(400, 'not a PDF')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def run(port=port, n_workers=n_workers, max_queue=max_queue):
+    BlankHandler.service = BlankService(n_workers, max_queue)
+    httpd = ThreadingHTTPServer(('', port), BlankHandler)
+    print('blank_server: port=%d n_workers=%d max_queue=%d' % (port, n_workers, max_queue))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+    BlankHandler.service.executor.shutdown()
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) == 2:
+        run(port=int(argv[1]))
+    else:
+        run()
@@ -1,9 +1,13 @@
 """
     PDF to text conversion
 """
+import os
 import string
 import re
-from ngrams import Pw
+import time
+from collections import Counter
+import numpy as np
+from ngrams import Pw, Pdist, sorted_arrays, array_paths, save_array
 
 
 RE_SPACE = re.compile(r'[\t ]+', re.MULTILINE | re.DOTALL)
@@ -14,6 +18,11 @@ RE_BREAK = re.compile(r'(\w+)-([\n\f\r]+)(\w+)([%s]*)\s*' % punctuation,
 
 hyphenated = set()
 
+# Hyphenation decision table settings
+HYPHEN_TABLE = 'hyphen_decisions'  # Base name of the table arrays. They are next to count_1w.txt
+use_hyphen_table = True            # dehyphenate looks up breaks in the table before using Pw
+max_table_breaks = 500000          # Number of the most common corpus breaks in the table
+
 
 def unbreak(m):
     global hyphenated
@@ -44,7 +53,147 @@ def unbreak(m):
     return words[best]
 
 
-def dehyphenate(text):
+def dehyphenate_reference(text):
+    """The original dehyphenate. It calls Pw for each break and adds the hyphenated words to
+        the global `hyphenated`. dehyphenate gives the same output.
+    """
+    assert isinstance(text, str), type(text)
+    # print([type(x) for x in (text, RE_BREAK, unbreak)])
+    unbroke = RE_BREAK.sub(unbreak, text)
+    return unbroke
+
+
+def unbreak_decision(p0, p1, p2, p_prefix, p_suffix):
+    """The unbreak decision for a break with probabilities p0, p1, p2 of the words in unbreak()
+        and p_prefix, p_suffix of the text before and after the break.
+        Returns: 0 to keep the break, 1 to keep the hyphen, 2 to join the parts
+    """
+    if p1 < 1e-32 and p2 < 1e-34:
+        p1a = p_prefix * p_suffix
+        if p1a > 1e-27:
+            p1 = p1a
+    _, best = max((p, i) for i, p in enumerate([p0, p1, p2]))
+    return best
+
+
+def break_decisions(breaks):
+    """Make the unbreak decisions for `breaks`, a list of RE_BREAK (prefix, newlines, suffix)
+        groups, with one Pw lookup for all of them.
+        Returns: {(prefix, newlines, suffix): decision}
+    """
+    words = []
+    for g1, g2, g3 in breaks:
+        words.extend([g1 + '-' + g2 + g3, g1 + '-' + g3, g1, g3])
+    probs = Pw(words).tolist() if words else []
+    decisions = {}
+    for i, key in enumerate(breaks):
+        p0, p1, p_prefix, p_suffix = probs[4 * i:4 * i + 4]
+        # unbreak() uses Pw(w1) for the joined word too. Keep that so that the output is unchanged
+        decisions[key] = unbreak_decision(p0, p1, p1, p_prefix, p_suffix)
+    return decisions
+
+
+def break_key(g1, g2, g3):
+    """Returns: the text of break (prefix, newlines, suffix) up to the end of the suffix, which is
+        unique for each break as the prefix and suffix can't contain '-' or newlines
+    """
+    return g1 + '-' + g2 + g3
+
+
+def corpus_breaks(path_list):
+    """Returns: Counter of the RE_BREAK (prefix, newlines, suffix) breaks in the text files and
+        summaries in `path_list`
+    """
+    breaks = Counter()
+    for text in corpus_pages(path_list):
+        breaks.update(m.group(1, 2, 3) for m in RE_BREAK.finditer(text))
+    return breaks
+
+
+def dictionary_breaks():
+    """Returns: set of the (prefix, newline, suffix) breaks of the hyphenated words in count_1w.txt
+        split at a line end
+    """
+    keys = Pw.load().keys
+    breaks = set()
+    for b in keys[np.char.find(keys, b'-') >= 0].tolist():
+        word = b.decode('utf-8')
+        for m in re.finditer(r'(\w+)-(?=(\w+))', word):
+            breaks.add((m.group(1), '\n', m.group(2)))
+    return breaks
+
+
+def table_path():
+    return os.path.join(os.path.dirname(Pw.name), HYPHEN_TABLE)
+
+
+def build_hyphen_table(path_list, max_breaks=max_table_breaks):
+    """Build the hyphenation decision table from the `max_breaks` most common breaks in the text
+        files and summaries in `path_list` and the hyphenated words in count_1w.txt, and save it
+        to the array_paths() of table_path(). The table must be rebuilt when count_1w.txt changes.
+    """
+    t0 = time.perf_counter()
+    breaks = {key for key, _ in corpus_breaks(path_list).most_common(max_breaks)}
+    n_corpus = len(breaks)
+    breaks |= dictionary_breaks()
+    breaks = sorted(breaks)
+    decisions = break_decisions(breaks)
+    keys, values = sorted_arrays({break_key(*key): best for key, best in decisions.items()})
+    for path, arr in zip(array_paths(table_path()), (keys, values.astype(np.uint8))):
+        save_array(path, arr)
+    decision_table.reset()
+    n_decisions = Counter(decisions.values())
+    print('build_hyphen_table: %d breaks (%d corpus %d dictionary) keep=%d hyphen=%d join=%d '
+          '%.1f KB %.1f sec' % (len(breaks), n_corpus, len(breaks) - n_corpus, n_decisions[0],
+          n_decisions[1], n_decisions[2], (keys.nbytes + len(values)) / 1024,
+          time.perf_counter() - t0))
+
+
+class DecisionTable:
+    """The hyphenation decision table saved by build_hyphen_table(), loaded on first use. It is
+        not used if it is missing or older than count_1w.txt.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.table = None
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            paths = array_paths(table_path())
+            if all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(Pw.name)
+                   for path in paths):
+                keys, values = (np.load(path, mmap_mode='r') for path in paths)
+                self.table = Pdist(N=1, keys=keys, counts=values)
+        return self.table
+
+    def lookup(self, breaks):
+        """Returns: {(prefix, newlines, suffix): decision} for the breaks in list `breaks` that
+            are in the table
+        """
+        table = self.load()
+        if table is None or not breaks:
+            return {}
+        values, found = table.lookup([break_key(*key) for key in breaks])
+        known = {key: best for key, best, ok in zip(breaks, values.tolist(), found.tolist()) if ok}
+        self.hits += len(known)
+        self.misses += len(breaks) - len(known)
+        return known
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+decision_table = DecisionTable()
+
+
+def dehyphenate(text, decisions=None, hyphenated=None):
     """
         The businesses around newspapers, books, and mag-
         azines are changing on a daily basis; even still, global electronic com-
@@ -53,8 +202,95 @@ def dehyphenate(text):
         The businesses around newspapers, books, and magazines
         are changing on a daily basis; even still, global electronic communication
         over the Internet
+
+        Gives the same output as dehyphenate_reference. The breaks in `text` are looked up in the
+        hyphenation decision table, and the probabilities of the rest are looked up at once.
+        decisions: optional dict of break decisions from earlier calls, e.g. for the other pages
+            of a document. It is updated with the decisions for `text`
+        hyphenated: optional set that the (w1, w2) pairs of breaks that are not joined are added to
     """
     assert isinstance(text, str), type(text)
-    # print([type(x) for x in (text, RE_BREAK, unbreak)])
-    unbroke = RE_BREAK.sub(unbreak, text)
-    return unbroke
+    matches = [(m.span(), m.groups()) for m in RE_BREAK.finditer(text)]
+    if not matches:
+        return text
+    if decisions is None:
+        decisions = {}
+    new_breaks = list({groups[:3] for _, groups in matches} - decisions.keys())
+    if use_hyphen_table:
+        known = decision_table.lookup(new_breaks)
+        decisions.update(known)
+        new_breaks = [key for key in new_breaks if key not in known]
+    decisions.update(break_decisions(new_breaks))
+
+    parts = []
+    pos = 0
+    for (start, end), (g1, g2, g3, g4) in matches:
+        best = decisions[g1, g2, g3]
+        parts.append(text[pos:start])
+        if best == 0:
+            parts.append(text[start:end])
+        elif best == 1:
+            parts.append(g1 + '-' + g3 + g4 + '\n')
+        else:
+            parts.append(g1 + g3 + g4 + '\n')
+        if hyphenated is not None and best != 2:
+            hyphenated.add((g1 + '-' + g3, g1 + g3))
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def corpus_pages(path_list):
+    """Generate the page texts of the text files and summaries in `path_list`. A text file is one
+        page.
+    """
+    from summary_store import load_summary
+
+    for path in path_list:
+        if path.endswith('.json') or path.endswith('.psum'):
+            yield from load_summary(path, ['page_texts']).get('page_texts', [])
+        else:
+            with open(path, 'r', errors='replace') as f:
+                yield f.read()
+
+
+def compare_dehyphenate(path_list):
+    """Check that dehyphenate gives the same text as dehyphenate_reference for all the pages in the
+        text files and summaries in `path_list` and report the speed of each.
+        Returns: number of pages whose text differs
+    """
+    pages = list(corpus_pages(path_list))
+    n_bytes = sum(len(text.encode('utf-8')) for text in pages)
+
+    t0 = time.perf_counter()
+    reference = [dehyphenate_reference(text) for text in pages]
+    t1 = time.perf_counter()
+    fast = [dehyphenate(text) for text in pages]
+    t2 = time.perf_counter()
+    decisions = {}
+    shared = [dehyphenate(text, decisions) for text in pages]
+    t3 = time.perf_counter()
+
+    n_diffs = 0
+    for i, (text_ref, text_fast, text_shared) in enumerate(zip(reference, fast, shared)):
+        if text_fast != text_ref or text_shared != text_ref:
+            n_diffs += 1
+            print('DIFFERENT: page %d\n%r\n%r' % (i, text_ref[:200], text_fast[:200]))
+    print('compare_dehyphenate: %d files %d pages %.1f MB %d distinct breaks %d differences' % (
+          len(path_list), len(pages), n_bytes / 1e6, len(decisions), n_diffs))
+    for name, dt in [('reference', t1 - t0), ('dehyphenate', t2 - t1), ('shared', t3 - t2)]:
+        print('%12s: %6.2f sec %6.2f MB/sec' % (name, dt, n_bytes / 1e6 / max(dt, 1e-9)))
+    if use_hyphen_table:
+        print('decision table: %d hits %d misses (%.1f%% hits)' % (decision_table.hits,
+              decision_table.misses, 100.0 * decision_table.hit_rate()))
+    return n_diffs
+
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1] == '--build':
+        build_hyphen_table(sys.argv[2:])
+        sys.exit()
+
+    compare_dehyphenate(sys.argv[1:])
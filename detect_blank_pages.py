@@ -2,16 +2,28 @@
     Find blank pages in documents
 """
 import os
-from glob import glob
+import json
 from collections import defaultdict
-from utils_peter import load_json, save_json, base_name
+from utils_peter import base_name
+from summary_store import load_summary, summary_paths
+from html_to_text import PAGE_BREAK
+from page_index import open_index, index_path, update_index, query_pages
 from bs4 import BeautifulSoup
+import numpy as np
 import re
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 # from blanks import blank_pages_map
 
 
+n_workers = os.cpu_count() or 1
+max_pending = 4  # Tasks queued per worker in find_empty_pages_corpus
+RESULTS_NAME = 'empty_pages.jsonl'  # find_empty_pages_corpus results file in the summary directory
+
+
 def get_page_summary(summary_path, prefix_len):
-    summary = load_json(summary_path)
+    summary = load_summary(summary_path, ['page_summaries', 'page_texts'])
     page_summaries = summary['page_summaries']
     for i in range(len(page_summaries)):
         page_summaries[i]['text'] = summary['page_texts'][i][:prefix_len].replace('\n', ' ')
@@ -19,15 +31,20 @@ def get_page_summary(summary_path, prefix_len):
 
 
 def get_text(summary_path):
-    summary = load_json(summary_path)
-    return summary['text']
+    """Return the PdfBox html of the summarized PDF. Summaries no longer store the whole document
+        so it is rebuilt from the pages if necessary.
+    """
+    summary = load_summary(summary_path, ['text', 'pages'])
+    if 'text' in summary:
+        return summary['text']
+    return ''.join(PAGE_BREAK + page for page in summary['pages'])
 
 
 def get_page_texts(summary_path):
     """Return 'page_texts' field of json dict with path `summary_path`.
         This is a list of one string per page for the pages in the summarized PDF.
     """
-    summary = load_json(summary_path)
+    summary = load_summary(summary_path, ['page_texts'])
     return summary['page_texts']
 
 
@@ -85,15 +102,101 @@ def find_same(index_text, indexes, text):
     return indexes_watermark
 
 
+SHINGLE_LEN = 8  # Longest shingles used by shingle_filter
+
+
+def shingles(text, k):
+    """Returns: array of the hashes of the `k` character substrings of `text`"""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    h = np.zeros(n, dtype=np.uint64)
+    for t in range(k):
+        h = h * np.uint64(1000003) + codes[t:t + n]  # Wraps around mod 2^64
+    return h
+
+
+def shingle_filter(index_text, indexes, candidates, k):
+    """Returns: set of the positions in `candidates` whose page text could be contained in all the
+        pages after it in `indexes`: every `k` character shingle of the text is in all those pages.
+        This is a necessary condition so the survivors must still be checked. It is one pass from
+        the longest page to the first candidate, intersecting the pages' shingle sets.
+    """
+    candidate_set = set(candidates)
+    passed = set()
+    common = np.unique(shingles(index_text[indexes[-1]], k))  # Shingles in all pages after pos
+    for pos in range(len(indexes) - 2, candidates[0] - 1, -1):
+        page_shingles = shingles(index_text[indexes[pos]], k)
+        if pos in candidate_set and np.isin(page_shingles, common).all():
+            passed.add(pos)
+        page_shingles.sort()
+        i = np.minimum(np.searchsorted(page_shingles, common), len(page_shingles) - 1)
+        common = common[page_shingles[i] == common] if len(page_shingles) else common[:0]
+        if not len(common):
+            break  # No text of `k` or more characters is in all the remaining pages
+    return passed
+
+
 def find_watermark_pages(page_texts, min_len, max_len):
     """Find the pages in the page text list `page_texts` (created by  make_page_corpus.py) that
         contain only a text watermark
         where watermark length is between `min_len` and `max_len` characters inclusive.
         Returns: indexes of watermarked pages, text of watermark
+
+        Gives the same result as find_watermark_pages_naive: the watermark is the text of the
+        shortest candidate page that is contained in all longer pages. Candidates are checked in
+        the same order, each text once. When the searches have covered more characters than
+        there are in `page_texts`, the remaining candidates are first checked with
+        shingle_filter so that only those that can pass are searched for.
     """
     index_text = {i: text for i, text in enumerate(page_texts)}
     indexes = list(index_text)
     indexes.sort(key=lambda i: (len(index_text[i]), index_text[i]))
+    if len(indexes) < 2:
+        return [], None
+
+    candidates = []
+    for i, idx in enumerate(indexes[:-1]):
+        if len(index_text[idx]) < min_len:
+            continue
+        if len(index_text[idx]) >= max_len:
+            break
+        candidates.append(i)
+
+    budget = sum(len(text) for text in page_texts)
+    n_searched = 0
+    passed = None
+    tried = set()
+    for i in candidates:
+        text = index_text[indexes[i]]
+        # Equal texts are adjacent in `indexes` so a text that failed fails again
+        if text in tried:
+            continue
+        tried.add(text)
+        if passed is None and n_searched > budget:
+            passed = shingle_filter(index_text, indexes, candidates, max(min(min_len, SHINGLE_LEN), 1))
+        if passed is not None and i not in passed:
+            continue
+        ok = True
+        for k in indexes[i + 1:]:
+            page = index_text[k]
+            n_searched += len(page)
+            if text not in page:
+                ok = False
+                break
+        if ok:
+            indexes_watermark = find_same(index_text, indexes[i + 1:], text)
+            assert all(len(page_texts[j]) < 200 for j in indexes_watermark)
+            return indexes_watermark, text
+    return [], None
+
+
+def find_watermark_pages_naive(page_texts, min_len, max_len):
+    """Reference version of find_watermark_pages. O(n^2) substring searches for n pages."""
+    index_text = {i: text for i, text in enumerate(page_texts)}
+    indexes = list(index_text)
+    indexes.sort(key=lambda i: (len(index_text[i]), index_text[i]))
     if len(indexes) >= 2:
         for i, idx in enumerate(indexes[:-1]):
             text = index_text[idx]
@@ -110,6 +213,78 @@ def find_watermark_pages(page_texts, min_len, max_len):
     return [], None
 
 
+WORDS = ('the of and to in is that for it as was with be by on not he this are or his from at '
+         'which but have an they you were her she there been one all we their has would when '
+         'printing document page classes differently double sided colour').split()
+
+
+def synthetic_pages(n_pages, kind, page_len=2000, seed=0):
+    """Return `n_pages` page texts for timing find_watermark_pages.
+        kind: 'watermark': Some pages contain only a watermark that is on all other pages.
+              'random': Random text with some short pages.
+              'near': Many short pages that are contained in all longer pages but the last.
+              'boilerplate': Half the pages are distinct short pieces of boilerplate text that is
+                  on all the other pages.
+              'nested': Short pages of increasing length that are each contained in all longer
+                  pages but the last.
+    """
+    rand = random.Random(seed)
+
+    def words(n_chars):
+        text = []
+        n = 0
+        while n < n_chars:
+            w = rand.choice(WORDS)
+            text.append(w)
+            n += len(w) + 1
+        return ' '.join(text)
+
+    mark = 'CONFIDENTIAL - DO NOT COPY'
+    if kind == 'watermark':
+        pages = ['%d\n%s' % (i + 1, mark) if i % 500 == 9 else
+                 mark if i % 500 == 7 else
+                 '%s\n%s\n%d' % (words(page_len), mark, i + 1)
+                 for i in range(n_pages)]
+    elif kind == 'random':
+        pages = [words(rand.randint(10, 150) if i % 10 == 0 else rand.randint(page_len // 2, page_len))
+                 for i in range(n_pages)]
+    elif kind == 'near':
+        pages = [mark if i % 2 else '%s\n%s' % (words(page_len), mark) for i in range(n_pages - 1)]
+        pages.append(words(2 * page_len))
+    elif kind == 'boilerplate':
+        boilerplate = words(page_len // 2)
+        pages = []
+        for i in range(n_pages // 2):
+            n = rand.randint(min(20, len(boilerplate)), min(150, len(boilerplate)))
+            start = rand.randint(0, len(boilerplate) - n)
+            pages.append(boilerplate[start:start + n])
+        pages.extend('%s\n%s\n%d' % (words(page_len // 2), boilerplate, i + 1)
+                     for i in range(n_pages - len(pages)))
+    elif kind == 'nested':
+        boilerplate = words(page_len // 2)
+        pages = [boilerplate[:10 + i % 180] for i in range(n_pages // 2)]
+        pages.extend('%s\n%s' % (words(page_len // 2), boilerplate)
+                     for i in range(n_pages - len(pages) - 1))
+        pages.append(words(2 * page_len))
+    else:
+        assert False, kind
+    return pages
+
+
+def time_find_watermark(n_pages=10000, min_len=5, max_len=200):
+    """Time find_watermark_pages and find_watermark_pages_naive on synthetic documents"""
+    for kind in ('watermark', 'random', 'near', 'boilerplate', 'nested'):
+        page_texts = synthetic_pages(n_pages, kind)
+        t0 = time.perf_counter()
+        result_naive = find_watermark_pages_naive(page_texts, min_len, max_len)
+        t1 = time.perf_counter()
+        result = find_watermark_pages(page_texts, min_len, max_len)
+        t2 = time.perf_counter()
+        assert result == result_naive, kind
+        print('time_find_watermark: %-10s %6d pages %3d watermarked naive=%7.3f sec fast=%7.3f sec' % (
+              kind, n_pages, len(result[0]), t1 - t0, t2 - t1))
+
+
 def add_lists(a, b):
     return sorted(set(a) | set(b))
 
@@ -158,14 +333,67 @@ def assign_blanks(path):
     return blank_pages_map[pdf]
 
 
-def find_empty_pages_corpus(root, max_files):
-    """Analyze up to `max_files` of the json files in directory `root` which are created by
-        make_page_corpus.py
+def result_key(path, min_len, max_len):
+    """Returns: what a find_empty_pages_corpus result for summary `path` depends on: the summary's
+        mtime and size and the detection parameters
+    """
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size, min_len, max_len]
+
+
+def empty_pages_task(path, blanks, min_len=5, max_len=200):
+    """Run find_empty_pages on summary `path` in a worker process.
+        Returns: result dict for the RESULTS_NAME file
+    """
+    result = {'path': path, 'name': base_name(path), 'key': result_key(path, min_len, max_len)}
+    t0 = time.perf_counter()
+    try:
+        n_pages, indexes_empty, indexes_watermark, text_watermark, pages_watermark = find_empty_pages(
+            path, blanks, min_len, max_len)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    else:
+        result.update({
+            'n_pages': n_pages,
+            'indexes_empty': indexes_empty,
+            'indexes_watermark': indexes_watermark,
+            'text_watermark': text_watermark,
+            'pages_watermark': pages_watermark,
+        })
+    result['duration'] = time.perf_counter() - t0
+    return result
+
+
+def load_results(results_path):
+    """Returns: {path: result} for the results in JSONL file `results_path` that have no error.
+        A partial last line left by a crash is ignored.
+    """
+    results = {}
+    if not os.path.exists(results_path):
+        return results
+    with open(results_path, 'r') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' not in result:
+                results[result['path']] = result
+    return results
+
+
+def find_empty_pages_corpus(root, max_files, n_workers=n_workers, min_len=5, max_len=200,
+                            restart=False):
+    """Analyze up to `max_files` of the summary files in directory `root` which are created by
+        make_page_corpus.py using `n_workers` processes.
+        Each document's result is appended to JSONL file RESULTS_NAME in `root` as it completes.
+        Documents that already have a result there for the same summary file and parameters are
+        not analyzed again so an interrupted run can be resumed. `restart` discards the results.
         Write results to stdout
 
         Returns: list of (name, n_pages, indexes_empty, indexes_watermark, text_watermark)
     """
-    path_list = sorted(glob(os.path.join(root, '*.json')))
+    path_list = summary_paths(root)
     path_blanks = {path: assign_blanks(path) for path in path_list}
 
     if True:
@@ -181,15 +409,60 @@ def find_empty_pages_corpus(root, max_files):
     # path_list = [os.path.join(root, '2013-12-12_rg_final_report.json.json')]
     if max_files > 0:
         path_list = path_list[:max_files]
-    print('%d files' % len(path_list))
+    results_path = os.path.join(root, RESULTS_NAME)
+    results = {} if restart else load_results(results_path)
+    results = {path: result for path, result in results.items()
+               if path in path_blanks and result.get('key') == result_key(path, min_len, max_len)}
+    todo = [path for path in path_list if path not in results]
+    print('%d files %d done %d to analyze' % (len(path_list), len(path_list) - len(todo), len(todo)))
+
+    n_docs = n_pages = n_errors = 0
+    t0 = time.perf_counter()
+    with open(results_path, 'w' if restart else 'a') as f:
+
+        def report(result):
+            nonlocal n_docs, n_pages, n_errors
+            print(json.dumps(result, sort_keys=True), file=f, flush=True)
+            n_docs += 1
+            if 'error' in result:
+                n_errors += 1
+                print('%4d of %d: %s FAILED %s' % (n_docs, len(todo), result['path'], result['error']))
+                return
+            results[result['path']] = result
+            n_pages += result['n_pages']
+            print('%4d of %d: %s %d pages %d empty %d watermark' % (n_docs, len(todo),
+                  result['path'], result['n_pages'], len(result['indexes_empty']),
+                  len(result['indexes_watermark'])), flush=True)
+
+        if n_workers <= 1:
+            for path in todo:
+                report(empty_pages_task(path, path_blanks[path], min_len, max_len))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                pending = set()
+                for path in todo:
+                    if len(pending) >= max_pending * n_workers:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            report(future.result())
+                    pending.add(executor.submit(empty_pages_task, path, path_blanks[path], min_len,
+                                                max_len))
+                for future in wait(pending)[0]:
+                    report(future.result())
+
+    duration = time.perf_counter() - t0
+    print('find_empty_pages_corpus: %d docs %d pages %d errors %.1f sec (%.2f docs/sec %.1f '
+          'pages/sec) n_workers=%d' % (n_docs, n_pages, n_errors, duration,
+          n_docs / max(duration, 1e-6), n_pages / max(duration, 1e-6), n_workers))
+
     empty_docs = []
     for path in path_list:
-
-        n_pages, indexes_empty, indexes_watermark, text_watermark, pages_watermark = find_empty_pages(
-            path, path_blanks[path], min_len=5, max_len=200)
-        if indexes_empty or indexes_watermark:
-            empty_docs.append((base_name(path), n_pages, indexes_empty, indexes_watermark,
-                text_watermark, pages_watermark))
+        if path not in results:
+            continue
+        r = results[path]
+        if r['indexes_empty'] or r['indexes_watermark']:
+            empty_docs.append((r['name'], r['n_pages'], r['indexes_empty'], r['indexes_watermark'],
+                r['text_watermark'], r['pages_watermark']))
     empty_docs.sort(key=lambda x: (-len(x[2]) - len(x[3]), -len(x[3]), x[1], x[0]))
     print('@' * 100)
     for name, n_pages, indexes_empty, indexes_watermark, text_watermark, pages_watermark in empty_docs:
@@ -212,34 +485,29 @@ def find_empty_pages_corpus(root, max_files):
 
 
 def summarize_all(root, prefix_len, max_files):
-    path_list = list(glob(os.path.join(root, '*.json')))
+    """Write all the pages in the first `max_files` (all if <= 0) summaries in directory `root` to
+        page_info_list.json in order of increasing size. The pages are read from the page index so
+        the corpus is never held in memory.
+    """
+    conn = open_index(index_path(root))
+    update_index(conn, root, max_files)
+    names = None
     if max_files > 0:
-        path_list = path_list[:max_files]
-    print('%d files' % len(path_list))
-    page_summaries = {base_name(path): get_page_summary(path, prefix_len) for path in path_list}
-    doc_page = {(name, i): summary
-                for name, summaries in page_summaries.items()
-                for i, summary in enumerate(summaries)
-               }
-    page_list = list(doc_page)
-    page_list.sort(key=lambda k: (doc_page[k]['n_chars'], doc_page[k]['n_lines'], k))
-
-    def extend_dict(page, info):
-        info['_name'] = page[0]
-        info['_page'] = page[1]
-        return info
-
-    page_info_list = [extend_dict(page, doc_page[page]) for page in page_list]
-    save_json('page_info_list.json', page_info_list)
+        names = [base_name(path) for path in summary_paths(root)[:max_files]]
 
     doc_count = defaultdict(int)
-    for i, page in enumerate(page_list):
-        doc_count[page[0]] += 1
-        if doc_count[page[0]] >= 3:
-            continue
-        info = doc_page[page]
-        print('%6d: %4d l %5d c - %-30s "%s"' % (i, info['n_lines'], info['n_chars'],
-            page, info['text']))
+    with open('page_info_list.json', 'w') as f:
+        f.write('[')
+        for i, info in enumerate(query_pages(conn, prefix_len=prefix_len, names=names)):
+            f.write('%s\n    %s' % (',' if i else '', json.dumps(info, sort_keys=True)))
+            page = (info['_name'], info['_page'])
+            doc_count[page[0]] += 1
+            if doc_count[page[0]] >= 3:
+                continue
+            print('%6d: %4d l %5d c - %-30s "%s"' % (i, info['n_lines'], info['n_chars'],
+                page, info['text']))
+        f.write('\n]')
+    conn.close()
 
 
 RE_TAG = re.compile(r'<.*?>')
@@ -255,7 +523,7 @@ def trim(tag):
 def find_all_tags(root, do_soup):
     print('=' * 80)
     all_tags = defaultdict(int)
-    path_list = list(glob(os.path.join(root, '*.json')))
+    path_list = summary_paths(root)
     for i, path in enumerate(path_list):
         print('%3d: %s %8d' % (i, path, os.path.getsize(path)))
         text = get_text(path)
@@ -26,7 +26,7 @@ def load_pages():
         len(path_pages), pages))
 
 
-RE_URL = re.compile(r'^http://localhost:8000/(.+?)#page=(\d+)(?:&view=Fit)?$')
+RE_URL = re.compile(r'^http://localhost:8000/(.+?)(?:\?page=|#page=)(\d+)(?:&view=Fit)?$')
 
 
 def collect_pages(ppt_list):
@@ -2,25 +2,77 @@
     PDF to text conversion
 """
 import os
-import json
-from bs4 import BeautifulSoup
+import re
+import time
+from html import unescape
 from clean import dehyphenate
+from summary_store import load_summary, save_summary, summary_paths
 
 
-# summary=['n_chars', 'n_pages', 'name', 'page_lines', 'page_summaries', 'page_texts', 'pages', 'text']
+# Text extraction engine used by html_to_text
+#   'fast': Regular expressions tuned to PdfBox's ExtractText -html output
+#   'html5lib': BeautifulSoup with the html5lib parser. Slow but handles any html
+html_engine = 'fast'
+
+
+PAGE_BREAK = '<div style="page-break-before:always; page-break-after:always">'
+
+
+def html_pages(text):
+    """Generate the html of each page of PdfBox html document `text`.
+        Same as text.split(PAGE_BREAK)[1:] without building the list.
+    """
+    pos = text.find(PAGE_BREAK)
+    while pos >= 0:
+        start = pos + len(PAGE_BREAK)
+        pos = text.find(PAGE_BREAK, start)
+        yield text[start:pos] if pos >= 0 else text[start:]
+
+
+def page_info(page):
+    """Returns: text, lines and page summary of html `page`"""
+    text = html_to_text(page)
+    lines = text.split('\n')
+    psummary = {
+        'n_chars': sum(len(l) for l in lines),
+        'n_lines': len(lines),
+    }
+    return text, lines, psummary
+
+
+def summarize_html(summary, text):
+    """Add the pages of PdfBox html document `text` and their text, lines and page summaries to
+        `summary`. The document is walked once, one page at a time.
+    """
+    pages = []
+    page_texts = []
+    page_lines = []
+    page_summaries = []
+    for page in html_pages(text):
+        page_text, lines, psummary = page_info(page)
+        pages.append(page)
+        page_texts.append(page_text)
+        page_lines.append(lines)
+        page_summaries.append(psummary)
+
+    summary['n_pages'] = len(pages)
+    summary['n_chars'] = sum(len(page) for page in pages)
+    summary['pages'] = pages
+    summary['page_texts'] = page_texts
+    summary['page_lines'] = page_lines
+    summary['page_summaries'] = page_summaries
+
+
+# summary=['n_chars', 'n_pages', 'name', 'page_lines', 'page_summaries', 'page_texts', 'pages']
 def update_summary(summary):
+    """Recompute the text, lines and page summaries of the pages in `summary`"""
     page_texts = []
     page_summaries = []
     page_lines = []
     for page in summary['pages']:
-        text = html_to_text(page)
+        text, lines, psummary = page_info(page)
         page_texts.append(text)
-        lines = text.split('\n')
         page_lines.append(lines)
-        psummary = {
-            'n_chars': sum(len(l) for l in lines),
-            'n_lines': len(lines),
-        }
         page_summaries.append(psummary)
 
     summary['page_texts'] = page_texts
@@ -28,7 +80,10 @@ def update_summary(summary):
     summary['page_summaries'] = page_summaries
 
 
-def html_to_text(page):
+def soup_text(page):
+    """Return the text in html `page` as extracted by BeautifulSoup"""
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(page, "html5lib")
 
     # kill all script and style elements
@@ -36,7 +91,45 @@ def html_to_text(page):
         script.extract()    # rip it out
 
     # get text
-    text = soup.get_text()
+    return soup.get_text()
+
+
+RE_SKIP = re.compile(r'<(script|style)\b[^>]*>.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+RE_TAG = re.compile(r'<(?:/?[A-Za-z][^>]*|[!?][^>]*)>')
+
+
+RE_CHARREF = re.compile(r'&(#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[^\t\n\f <&#;]{1,32};?)')
+
+
+def charref(m):
+    """html.unescape drops references to invalid code points like &#1; but html5lib keeps them"""
+    ref = m.group(0)
+    text = unescape(ref)
+    if not text and ref[1] == '#':
+        num = ref[2:].rstrip(';')
+        text = chr(int(num[1:], 16) if num[0] in 'xX' else int(num, 10))
+    return text
+
+
+def fast_text(page):
+    """Return the text in html `page` as extracted by soup_text.
+        PdfBox escapes all markup characters in text and doesn't write tables, so stripping tags
+        and unescaping character references gives the same text as a full html5lib parse.
+    """
+    text = page.replace('\r\n', '\n').replace('\r', '\n')
+    text = RE_SKIP.sub('', text)
+    text = RE_TAG.sub('', text)
+    return RE_CHARREF.sub(charref, text).replace('\0', '')
+
+
+def html_to_text(page, engine=None):
+    """Return the text in html `page` with one phrase per line and hyphenated line breaks
+        joined. `engine` overrides `html_engine`
+    """
+    if (engine or html_engine) == 'html5lib':
+        text = soup_text(page)
+    else:
+        text = fast_text(page)
 
     # break into lines and remove leading and trailing space on each
     lines = (line.strip() for line in text.splitlines())
@@ -49,18 +142,49 @@ def html_to_text(page):
     return text
 
 
+def compare_engines(path_list):
+    """Check that the 'fast' and 'html5lib' engines give identical text for all the pages in the
+        .json or .psum summary files `path_list` and report the speed of each.
+        Returns: number of pages whose text differs
+    """
+    n_pages = n_bytes = n_diffs = 0
+    t_soup = t_fast = 0.0
+    for path in path_list:
+        summary = load_summary(path, ['pages'])
+        for i, page in enumerate(summary['pages']):
+            t0 = time.perf_counter()
+            text_soup = soup_text(page)
+            t1 = time.perf_counter()
+            text_fast = fast_text(page)
+            t2 = time.perf_counter()
+            t_soup += t1 - t0
+            t_fast += t2 - t1
+            n_pages += 1
+            n_bytes += len(page)
+            if html_to_text(page, 'html5lib') != html_to_text(page, 'fast'):
+                n_diffs += 1
+                print('DIFFERENT: %s page %d\n%r\n%r' % (path, i, text_soup[:200], text_fast[:200]))
+    print('compare_engines: %d files %d pages %.1f MB %d differences' % (
+          len(path_list), n_pages, n_bytes / 1e6, n_diffs))
+    print('html5lib: %6.2f sec %6.2f MB/sec' % (t_soup, n_bytes / 1e6 / max(t_soup, 1e-9)))
+    print('    fast: %6.2f sec %6.2f MB/sec  %.0fx faster' % (t_fast, n_bytes / 1e6 / max(t_fast, 1e-9),
+          t_soup / max(t_fast, 1e-9)))
+    return n_diffs
+
+
 if __name__ == '__main__':
     import sys
 
+    if sys.argv[1] == '--compare':
+        path_list = []
+        for path in sys.argv[2:]:
+            path_list.extend(summary_paths(path) if os.path.isdir(path) else [path])
+        compare_engines(path_list)
+        sys.exit()
+
     summary_path = sys.argv[1]
     print('summmary_path=%s' % summary_path)
 
-    with open(summary_path, 'r') as f:
-        summary = json.load(f)
-
+    summary = load_summary(summary_path)
     update_summary(summary)
-
-    outtemp = '%s.tmp.json' % summary_path
-    with open(outtemp, 'w') as f:
-        json.dump(summary, f, indent=4, sort_keys=True)
-    os.rename(outtemp, summary_path)
+    save_summary(summary_path, summary)
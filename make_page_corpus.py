@@ -2,13 +2,22 @@
     PDF to text conversion
 """
 import os
+import io
+import time
 from glob import glob
-from collections import defaultdict, OrderedDict
+from fnmatch import fnmatchcase
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
 import hashlib
-from subprocess import CalledProcessError, Popen, PIPE
+from subprocess import CalledProcessError, Popen, PIPE, TimeoutExpired
 import re
 from utils_peter import pdf_dir, summary_dir, save_json
-from html_to_text import update_summary
+from summary_store import SUMMARY_EXT, load_summary, save_summary
+from html_to_text import summarize_html, html_pages
+from pdfbox_daemon import PdfBoxDaemon, DaemonError, compile_server
+from page_index import open_index, index_path, index_summary, update_index
 import json
 
 
@@ -18,6 +27,30 @@ MBYTE = 1024 * 1024
 # Settings
 min_size = 1 * KBYTE
 max_size = 10000 * MBYTE
+n_workers = os.cpu_count() or 1  # Number of PDFs processed concurrently by corpus_to_text
+max_pending = 4                  # Tasks queued per worker before we wait for the oldest one
+file_timeout = 10 * 60           # Seconds allowed for each external command run on a PDF
+use_daemon = True                # Extract text with a long lived PdfBoxDaemon
+daemon_max_docs = 1000           # PDFs processed by a PdfBoxDaemon JVM before it is restarted
+incremental = True               # Only summarize PDFs that are not in the summary_dir manifest
+hash_threads = 8                 # Threads computing SHA-1 digests in corpus_to_keepers
+
+# Files in pdf_dir are used if their path relative to pdf_dir matches one of `include_patterns` and
+# none of `exclude_patterns`. Directories that match `exclude_patterns` are not searched.
+include_patterns = ['*.pdf']
+exclude_patterns = [
+    'Year_8_Pythagoras_Booklet.pdf',
+    'missing.pdf',
+    'nsdi17-gowda.pdf',
+    'nsdi17-horn-daniel.pdf',
+    'rdp2018-03.pdf',
+]
+
+# Change this whenever the summaries written by save_pdf_summary change so that incremental runs
+# regenerate them.
+TOOL_VERSION = 'pdfbox-2.0.7/summary-2'
+MANIFEST_NAME = 'manifest.jsonl'
+HASH_CACHE_NAME = 'sha1_cache.jsonl'
 
 
 permission_errors = [
@@ -32,9 +65,14 @@ for path in [PDF_BOX, PDF_SUMMARIZE]:
     assert os.path.exists(path), path
 
 
-def run_command(cmd, raise_on_error=True):
+def run_command(cmd, raise_on_error=True, timeout=None):
     p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = p.communicate()
+    try:
+        stdout, stderr = p.communicate(timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        p.communicate()
+        raise
 
     if p.returncode != 0:
         so = ''
@@ -60,7 +98,7 @@ def run_command(cmd, raise_on_error=True):
 
 def pdf_summarize(pdf_path):
     cmd = [PDF_SUMMARIZE, pdf_path]
-    retcode, stdout, stderr = run_command(cmd, raise_on_error=False)
+    retcode, stdout, stderr = run_command(cmd, raise_on_error=False, timeout=file_timeout)
     ok = retcode == 0
     if not ok:
         print('FAILURE: retcode=%d stderr=<%s>' % (retcode, stderr))
@@ -70,6 +108,37 @@ def pdf_summarize(pdf_path):
     return ok, summary
 
 
+daemon = None
+
+
+def pdf_to_html(pdf_path):
+    """Extract text from PDF file `pdf_path` in html format using PdfBox.
+        A PdfBoxDaemon is used if `use_daemon` is set and it is working, otherwise a one-shot
+        `java -jar` command.
+        Returns: ok, text
+    """
+    global daemon, use_daemon
+
+    if use_daemon:
+        if daemon is None:
+            daemon = PdfBoxDaemon(PDF_BOX, max_docs=daemon_max_docs, timeout=file_timeout)
+        try:
+            return daemon.extract(pdf_path)
+        except DaemonError as e:
+            print('pdf_to_html: PdfBoxDaemon failed. Using one-shot command. %s' % e)
+            if daemon.broken:
+                use_daemon = False  # PdfBoxServer can't be started here
+
+    cmd = ['java', '-jar', PDF_BOX, 'ExtractText',
+           '-html', '-console', pdf_path]
+    retcode, stdout, stderr = run_command(cmd, raise_on_error=False, timeout=file_timeout)
+    ok = retcode == 0
+    if not ok:
+        print('FAILURE: retcode=%d stderr=<%s>' % (retcode, stderr))
+        return ok, ''
+    return ok, stdout.decode('utf-8')
+
+
 def pdf_to_pages(pdf_path):
     """Extract pages from PDF file `pdf_path` using PdfBox
         Returns: ok, text, pages
@@ -77,16 +146,10 @@ def pdf_to_pages(pdf_path):
             text: Text of PDF in html format
             pages: Pages of PDF in html format
     """
-    cmd = ['java', '-jar', PDF_BOX, 'ExtractText',
-           '-html', '-console', pdf_path]
-    retcode, stdout, stderr = run_command(cmd, raise_on_error=False)
-    ok = retcode == 0
+    ok, text = pdf_to_html(pdf_path)
     if not ok:
-        print('FAILURE: retcode=%d stderr=<%s>' % (retcode, stderr))
         return ok, '', []
-    text = stdout.decode('utf-8')
-    sep = '<div style="page-break-before:always; page-break-after:always">'
-    return ok, text, text.split(sep)[1:]
+    return ok, text, list(html_pages(text))
 
 
 # Num Pages: 1
@@ -110,26 +173,24 @@ xlation = {
     }
 
 
-def save_pdf_summary(pdf_path, summary_path):
-    """Extract text from `pdf`, break it into pages and write the summary to 'summary_path
+def pdf_to_summary(pdf_path):
+    """Extract text from `pdf_path`, break it into pages and summarize them
+        Returns: summary dict, or None if the PDF could not be analyzed
     """
-    ok, text, pages_html = pdf_to_pages(pdf_path)
+    ok, text = pdf_to_html(pdf_path)
     if not ok:
-        return
-    print('save_pdf_summary: %s->%s' % (pdf_path, summary_path))
+        return None
 
     summary = {
         'path': pdf_path,
         'name': os.path.basename(pdf_path),
-        'n_pages': len(pages_html),
-        'n_chars': sum(len(page) for page in pages_html),
-        'pages': pages_html,
-        'text': text,
     }
+    summarize_html(summary, text)
+    del text
 
     ok, pages_summary = pdf_summarize(pdf_path)
     if not ok:
-        return
+        return None
     assert pages_summary['NumPages'] == summary['n_pages'], (pdf_path, pages_summary['NumPages'],
                                                              summary['n_pages'])
     for k, v in pages_summary.items():
@@ -146,12 +207,142 @@ def save_pdf_summary(pdf_path, summary_path):
     # TextMarkedPages  []int
     # GraphMarkedPages []int
 
-    update_summary(summary)
+    return summary
+
 
-    if not summary_path.endswith('.json'):
-        summary_path = '%s.json' % summary_path
+def save_pdf_summary(pdf_path, summary_path):
+    """Extract text from `pdf`, break it into pages and write the summary to 'summary_path
+        Returns: True if the summary was written
+    """
+    summary = pdf_to_summary(pdf_path)
+    if summary is None:
+        return False
+    print('save_pdf_summary: %s->%s' % (pdf_path, summary_path))
+
+    if not summary_path.endswith(('.json', SUMMARY_EXT)):
+        summary_path = '%s%s' % (summary_path, SUMMARY_EXT)
     outpath = os.path.abspath(summary_path)
-    save_json(outpath, summary)
+    save_summary(outpath, summary)
+    return True
+
+
+def summary_task(pdf_path, summary_path):
+    """Run save_pdf_summary(`pdf_path`, `summary_path`) capturing its output so that it can be
+        run in a worker process.
+        Returns: pdf_path, summary_path, error
+            error: None on success, otherwise a dict describing the failure
+    """
+    t0 = time.perf_counter()
+    log = io.StringIO()
+    error = None
+    with redirect_stdout(log):
+        try:
+            if not save_pdf_summary(pdf_path, summary_path):
+                error = 'extraction failed'
+        except TimeoutExpired as e:
+            error = 'timeout after %d sec: %s' % (e.timeout, ' '.join(e.cmd))
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+    if error:
+        error = {
+            'path': pdf_path,
+            'error': error,
+            'duration': time.perf_counter() - t0,
+            'log': log.getvalue()[-2000:],
+        }
+    return pdf_path, summary_path, error
+
+
+def isolated_task(pdf_path, summary_path):
+    """Run summary_task(`pdf_path`, `summary_path`) in a process of its own so that a worker
+        death can be attributed to this file.
+        Returns: pdf_path, summary_path, error
+    """
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(summary_task, pdf_path, summary_path).result()
+        except BrokenProcessPool:
+            return pdf_path, summary_path, {
+                'path': pdf_path,
+                'error': 'worker process died',
+                'duration': time.perf_counter() - t0,
+                'log': '',
+            }
+
+
+def summarize_corpus(pdf_summary, n_workers, done=None):
+    """Run summary_task on the (pdf_path, summary_path) pairs in `pdf_summary` using a pool of
+        `n_workers` processes. At most `max_pending` * `n_workers` tasks are queued at once and
+        progress is reported in submission order. `done`(pdf_path, summary_path) is called for
+        each summary that is written.
+        Returns: list of failure dicts
+    """
+    tasks = list(pdf_summary.items())
+    failures = []
+    t0 = time.perf_counter()
+
+    def report(i, pdf_path, summary_path, error):
+        print('%4d of %d: %s -> %s %s' % (i, len(tasks), pdf_path, summary_path,
+              'FAILED' if error else 'ok'), flush=True)
+        if error:
+            failures.append(error)
+        elif done:
+            done(pdf_path, summary_path)
+
+    if n_workers <= 1:
+        for i, (pdf_path, summary_path) in enumerate(tasks):
+            report(i, *summary_task(pdf_path, summary_path))
+    else:
+        if use_daemon:
+            try:
+                compile_server(PDF_BOX)  # Once here rather than in every worker
+            except Exception as e:
+                print('summarize_corpus: could not compile PdfBoxServer: %s' % e)
+        pending = deque()
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+
+        def collect():
+            """Report the oldest pending task. If a worker died, every task that was in the pool
+               fails with BrokenProcessPool, so replace the pool and rerun such tasks one at a
+               time in isolated_task to find the file that killed it.
+            """
+            nonlocal executor
+            j, future, pool = pending.popleft()
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                if pool is executor:
+                    print('summarize_corpus: worker process died. Restarting pool', flush=True)
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=n_workers)
+                result = isolated_task(*tasks[j])
+            report(j, *result)
+
+        try:
+            for i, (pdf_path, summary_path) in enumerate(tasks):
+                if len(pending) >= max_pending * n_workers:
+                    collect()
+                try:
+                    future = executor.submit(summary_task, pdf_path, summary_path)
+                except BrokenProcessPool:  # Pool broke since the last collect()
+                    broken = executor
+                    while pending:
+                        collect()
+                    if executor is broken:
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=n_workers)
+                    future = executor.submit(summary_task, pdf_path, summary_path)
+                pending.append((i, future, executor))
+            while pending:
+                collect()
+        finally:
+            executor.shutdown()
+
+    duration = time.perf_counter() - t0
+    print('summarize_corpus: %d files %d failures %.1f sec (%.2f files/sec) n_workers=%d' % (
+          len(tasks), len(failures), duration, len(tasks) / max(duration, 1e-6), n_workers))
+    return failures
 
 
 def sha1_digest(path):
@@ -240,30 +431,147 @@ def find_keeper(paths, root):
     return {paths[0]}
 
 
-def corpus_to_keepers(pdf_dir):
-    """Return the unique files in `pdf_dir` that we will use"""
+def load_hash_cache(cache_path):
+    """Load the SHA-1 cache written by save_hash_cache
+        Returns: {path: (size, mtime_ns, inode, sha1)}
+    """
+    cache = {}
+    if not cache_path or not os.path.exists(cache_path):
+        return cache
+    with open(cache_path, 'r') as f:
+        for line in f:
+            try:
+                path, size, mtime_ns, inode, sha1 = json.loads(line)
+            except ValueError:
+                continue
+            cache[path] = (size, mtime_ns, inode, sha1)
+    return cache
+
+
+def save_hash_cache(cache_path, cache):
+    temp_path = '%s.tmp' % cache_path
+    with open(temp_path, 'w') as f:
+        for path in sorted(cache):
+            print(json.dumps([path] + list(cache[path])), file=f)
+    os.replace(temp_path, cache_path)
+
+
+def stat_key(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def scan_pdfs(root, include=None, exclude=None, counts=None):
+    """Generate the os.DirEntry of each regular file under directory `root` whose path relative to
+        `root` matches a pattern in `include` and no pattern in `exclude`. Hidden entries are
+        skipped as they are by glob. `counts` is updated with the numbers of entries seen.
+    """
+    if include is None:
+        include = include_patterns
+    if exclude is None:
+        exclude = exclude_patterns
+    if counts is None:
+        counts = defaultdict(int)
+
+    def matches(rel, patterns):
+        return any(fnmatchcase(rel, pattern) for pattern in patterns)
+
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print('scan_pdfs: %s' % e)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            counts['total'] += 1
+            rel = os.path.relpath(entry.path, root)
+            if matches(rel, exclude):
+                counts['excluded'] += 1
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                counts['files'] += 1
+                if matches(rel, include):
+                    counts['matched'] += 1
+                    yield entry
+        stack.extend(reversed(subdirs))
+
+
+def corpus_to_keepers(pdf_dir, hash_all=True, cache_path=None):
+    """Return the unique files in `pdf_dir` that we will use
+        Files are hashed as they are found by scan_pdfs. Only files with the same size as another
+        file are hashed, unless `hash_all` is set. Digests of files whose (size, mtime, inode)
+        match the cache in `cache_path` are not recomputed.
+        Returns: {path: sha1} sorted by path. sha1 is None for files that were not hashed
+    """
     print('corpus_to_keepers: pdf_dir="%s"' % pdf_dir)
 
-    path_list = list(glob(os.path.join(pdf_dir, '**'), recursive=True))
-    print('corpus_to_keepers: %d total' % len(path_list))
-    path_list = [path for path in path_list if os.path.isfile(path)]
-    print('corpus_to_keepers: %d files' % len(path_list))
-    path_list = [path for path in path_list if os.path.splitext(path)[1] == '.pdf']
-    print('corpus_to_keepers: %d pdf files' % len(path_list))
-    # for i, path in enumerate(path_list):
-    #     assert os.path.isfile(path), path
-    # path_list = [flatten_path(path, pdf_dir) for path in path_list]
-
+    cache = load_hash_cache(cache_path)
+    path_stat = OrderedDict()
+    size_first = {}  # {size: first path with this size or None if it has been hashed}
+    digests = {}
+    futures = OrderedDict()
+    n_read = n_skipped = 0
+    counts = defaultdict(int)
+
+    with ThreadPoolExecutor(max_workers=hash_threads) as executor:
+
+        def hash_path(path):
+            nonlocal n_skipped
+            st = path_stat[path]
+            entry = cache.get(path)
+            if entry and tuple(entry[:3]) == stat_key(st):
+                digests[path] = entry[3]
+                n_skipped += st.st_size
+            else:
+                futures[path] = executor.submit(sha1_digest, path)
+
+        for entry in scan_pdfs(pdf_dir, counts=counts):
+            path = entry.path
+            assert os.path.abspath(path) == path, (os.path.abspath(path), path)
+            st = entry.stat()
+            path_stat[path] = st
+            if hash_all:
+                hash_path(path)
+            elif st.st_size not in size_first:
+                size_first[st.st_size] = path
+            else:
+                first = size_first[st.st_size]
+                if first:
+                    hash_path(first)
+                    size_first[st.st_size] = None
+                hash_path(path)
+
+        for path, future in futures.items():
+            st = path_stat[path]
+            digests[path] = future.result()
+            cache[path] = stat_key(st) + (digests[path],)
+            n_read += st.st_size
+
+    print('corpus_to_keepers: %d total %d files %d pdf files %d excluded' % (
+          counts['total'], counts['files'], counts['matched'], counts['excluded']))
+    n_skipped += sum(st.st_size for path, st in path_stat.items() if path not in digests)
+    print('corpus_to_keepers: hashed %d of %d files. read %.1f MB skipped %.1f MB' % (
+          len(digests), len(path_stat), n_read / MBYTE, n_skipped / MBYTE))
+    if cache_path and (futures or len(cache) != len(digests)):
+        save_hash_cache(cache_path, {path: cache[path] for path in digests})
+
+    path_list = list(path_stat)
     sha1_paths = defaultdict(set)
     xarc = []
-    for i, path in enumerate(path_list):
-        assert os.path.isfile(path), path
-        assert os.path.abspath(path) == path, (os.path.abspath(path), path)
-        sha1 = sha1_digest(path)
-        sha1_paths[sha1].add(path)
+    for path in path_list:
+        # Files with a unique size are unique without needing a digest
+        key = digests.get(path, 'size=%d' % path_stat[path].st_size)
+        sha1_paths[key].add(path)
         if 'xarc' in path:
             xarc.append(path)
-    print('%d xarc files of %d (raw total: %d)' % (len(xarc), len(sha1_paths), i))
+    print('%d xarc files of %d (raw total: %d)' % (len(xarc), len(sha1_paths), len(path_list)))
     assert xarc
 
     for sha1 in sha1_paths:
@@ -271,30 +579,103 @@ def corpus_to_keepers(pdf_dir):
         if len(paths) > 1:
             sha1_paths[sha1] = find_keeper(paths, pdf_dir)
 
-    keepers = []
+    keepers = {}
     for paths in sha1_paths.values():
         assert len(paths) == 1, (len(paths), paths)
-        keepers.append(list(paths)[0])
-    keepers.sort()
-    return keepers
+        path = list(paths)[0]
+        keepers[path] = digests.get(path)
+    return OrderedDict(sorted(keepers.items()))
 
 
-exclusions = {
-    '~/testdata/Year_8_Pythagoras_Booklet.pdf',
-    '~/testdata/missing.pdf',
-    '~/testdata/nsdi17-gowda.pdf',
-    '~/testdata/nsdi17-horn-daniel.pdf',
-    '~/testdata/rdp2018-03.pdf',
-}
-exclusions = {os.path.expanduser(path) for path in exclusions}
+def add_manifest_entry(manifest, summary_keys, key, summary_path):
+    """Set manifest[`key`] to `summary_path`, removing the previous key for `summary_path` as
+        that summary has been overwritten. `summary_keys` is {summary_path: key} for `manifest`
+    """
+    old_key = summary_keys.get(summary_path)
+    if old_key is not None and old_key != key and manifest.get(old_key) == summary_path:
+        del manifest[old_key]
+    manifest[key] = summary_path
+    summary_keys[summary_path] = key
 
 
-def corpus_to_text(pdf_dir, summary_dir):
-    """Convert the unique PDF files in `pdf_dir` to file with the same name in `summary_dir`
+def load_manifest(summary_dir):
+    """Load the manifest of summaries in `summary_dir` written by corpus_to_text. Later entries
+        for a summary path replace earlier ones.
+        Returns: {(sha1, version): summary_path}
+    """
+    manifest = {}
+    summary_keys = {}
+    path = os.path.join(summary_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return manifest
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # Partly written line from an interrupted run
+            add_manifest_entry(manifest, summary_keys, (entry['sha1'], entry['version']),
+                               entry['summary'])
+    return manifest
+
+
+def reuse_summary(done_path, pdf_path, summary_path):
+    """Write a copy of summary `done_path` for identical PDF `pdf_path` to `summary_path`"""
+    summary = load_summary(done_path)
+    summary['path'] = pdf_path
+    summary['name'] = os.path.basename(pdf_path)
+    save_summary(summary_path, summary)
+
+
+def incremental_summaries(pdf_summary, keepers, summary_dir):
+    """Find the (pdf_path, summary_path) pairs in `pdf_summary` that need to be summarized given
+        the manifest in `summary_dir`. PDFs with the same SHA-1 and TOOL_VERSION as a manifest
+        entry are skipped. Their summary is copied if it was saved under a different name or in
+        a different format.
+        Returns: pdf_summary of PDFs to summarize, function to record a summary in the manifest
     """
-    keepers = corpus_to_keepers(pdf_dir)
+    manifest = load_manifest(summary_dir)
+    summary_keys = {path: key for key, path in manifest.items()}
+    manifest_path = os.path.join(summary_dir, MANIFEST_NAME)
+
+    def done(pdf_path, summary_path):
+        entry = {
+            'sha1': keepers[pdf_path],
+            'version': TOOL_VERSION,
+            'pdf': pdf_path,
+            'summary': summary_path,
+        }
+        with open(manifest_path, 'a') as f:
+            print(json.dumps(entry, sort_keys=True), file=f, flush=True)
+        add_manifest_entry(manifest, summary_keys, (entry['sha1'], entry['version']), summary_path)
+
+    todo = OrderedDict()
+    n_skipped = n_copied = 0
+    for pdf_path, summary_path in pdf_summary.items():
+        done_path = manifest.get((keepers[pdf_path], TOOL_VERSION))
+        if done_path and os.path.exists(done_path):
+            if done_path == summary_path:
+                n_skipped += 1
+                continue
+            reuse_summary(done_path, pdf_path, summary_path)
+            done(pdf_path, summary_path)
+            n_copied += 1
+            continue
+        todo[pdf_path] = summary_path
+    print('incremental_summaries: %d files: %d unchanged %d copied %d to summarize' % (
+          len(pdf_summary), n_skipped, n_copied, len(todo)))
+    return todo, done
+
 
+def corpus_to_text(pdf_dir, summary_dir, n_workers=n_workers):
+    """Convert the unique PDF files in `pdf_dir` to file with the same name in `summary_dir`
+        using `n_workers` processes. Failures are written to corpus_failures.json
+        If `incremental` is set, only PDFs that are new or have changed since the last run are
+        converted.
+    """
     os.makedirs(summary_dir, exist_ok=True)
+    keepers = corpus_to_keepers(pdf_dir, hash_all=incremental,
+                                cache_path=os.path.join(summary_dir, HASH_CACHE_NAME))
 
     pdf_summary = OrderedDict()
     summary_pdf = OrderedDict()
@@ -307,8 +688,8 @@ def corpus_to_text(pdf_dir, summary_dir):
 
         if min_size <= size <= max_size:
             name = extract_name(pdf_path, pdf_dir)
-            assert not name.endswith('.json'), name
-            name = '%s.json' % name
+            assert not name.endswith(('.json', SUMMARY_EXT)), name
+            name = '%s%s' % (name, SUMMARY_EXT)
             summary_path = os.path.join(summary_dir, name)
             assert summary_path not in summary_pdf, (pdf_path, summary_pdf[summary_path])
             pdf_summary[pdf_path] = summary_path
@@ -319,15 +700,24 @@ def corpus_to_text(pdf_dir, summary_dir):
         print()
 
     print('^' * 100)
-    started = set()
-    for i, (pdf_path, summary_path) in enumerate(pdf_summary.items()):
-        if pdf_path in exclusions:
-            started.add(pdf_path)
-            continue
-        # if len(started) < len(exclusions):
-        #     continue
-        print('%4d: %s -> %s' % (i, pdf_path, summary_path), flush=True)
-        save_pdf_summary(pdf_path, summary_path)
+    record = None
+    if incremental:
+        pdf_summary, record = incremental_summaries(pdf_summary, keepers, summary_dir)
+
+    # Add each summary to the page index as it is written
+    conn = open_index(index_path(summary_dir))
+
+    def done(pdf_path, summary_path):
+        if record:
+            record(pdf_path, summary_path)
+        index_summary(conn, summary_path)
+
+    failures = summarize_corpus(pdf_summary, n_workers, done)
+    update_index(conn, summary_dir)  # Copied summaries and summaries written by earlier runs
+    conn.close()
+    save_json('corpus_failures.json', failures)
+    for i, failure in enumerate(failures):
+        print('%4d: %s %s' % (i, failure['path'], failure['error']))
 
 
 if __name__ == '__main__':
@@ -8,23 +8,89 @@
     You are free to use this code under the MIT licencse:
     http://www.opensource.org/licenses/mit-license.php
 """
-import re, string, random, glob, operator, heapq
-from collections import defaultdict
+import os, re, string, random, glob, operator, heapq, time, tempfile
+from collections import defaultdict, OrderedDict
+from functools import reduce, wraps
 from math import log10
+import numpy as np
 
 
-def memo(f):
-    "Memoize function f."
-    table = {}
+memo_maxsize = 100000  # Default number of results kept by each memo()ized function. None for no limit
+memo_functions = []    # All memo()ized functions
+bigram_window = 256    # Offsets of a text whose bigrams viterbi2 looks up in one batch
 
+
+def memo(f=None, maxsize=None, key=None):
+    """Memoize function f, keeping the `maxsize` most recently used results, or the current
+        memo_maxsize if `maxsize` is None.
+        Use as @memo or @memo(maxsize=..., key=...). `key`(*args) gives the cache key for args. The
+        default is args itself.
+        The memoized function has hits, misses and evictions counters, cache_info() and
+        cache_clear(). clear_memos() clears all memoized functions, e.g. between documents.
+    """
+    if f is None:
+        return lambda f: memo(f, maxsize, key)
+    table = OrderedDict()
+
+    @wraps(f)
     def fmemo(*args):
-        if args not in table:
-            table[args] = f(*args)
-        return table[args]
+        k = args if key is None else key(*args)
+        try:
+            value = table[k]
+        except KeyError:
+            fmemo.misses += 1
+            value = f(*args)
+            table[k] = value
+            limit = memo_maxsize if maxsize is None else maxsize
+            if limit is not None and len(table) > limit:
+                table.popitem(last=False)
+                fmemo.evictions += 1
+            return value
+        fmemo.hits += 1
+        table.move_to_end(k)
+        return value
+
+    def cache_info():
+        return {'name': f.__name__, 'hits': fmemo.hits, 'misses': fmemo.misses,
+                'evictions': fmemo.evictions, 'size': len(table),
+                'maxsize': memo_maxsize if maxsize is None else maxsize}
+
+    def cache_clear():
+        table.clear()
+        fmemo.hits = fmemo.misses = fmemo.evictions = 0
+
     fmemo.memo = table
+    fmemo.cache_info = cache_info
+    fmemo.cache_clear = cache_clear
+    cache_clear()
+    memo_functions.append(fmemo)
     return fmemo
 
 
+def clear_memos():
+    "Clear the results of all memoized functions."
+    for fmemo in memo_functions:
+        fmemo.cache_clear()
+
+
+def memo_stats():
+    "Print the cache statistics of all memoized functions."
+    for fmemo in memo_functions:
+        info = fmemo.cache_info()
+        lookups = info['hits'] + info['misses']
+        print('%-24s hits=%8d misses=%8d (%5.1f%% hits) evictions=%8d size=%7d maxsize=%s' % (
+              info['name'], info['hits'], info['misses'], 100.0 * info['hits'] / max(lookups, 1),
+              info['evictions'], info['size'], info['maxsize']))
+
+
+def suffix_key(text, prev='<S>'):
+    """Cache key (offset from end, prev) for functions called on suffixes of one text, such as
+        segment2_suffix. It avoids hashing the suffixes but is only valid for one text at a
+        time, so the function's cache must be cleared before each new text.
+    """
+    return len(text), prev
+
+
 def test(verbose=None):
     """Run some tests, taken from the chapter.
     Since the hillclimbing algorithm is randomized, some tests may fail."""
@@ -35,13 +101,36 @@ def test(verbose=None):
 ################ Word Segmentation (p. 223)
 
 
-@memo
-def segment(text):
+def segment(text, L=20):
     "Return a list of words that is the best segmentation of text."
-    if not text:
-        return []
-    candidates = ([first]+segment(rem) for first, rem in splits(text))
-    return max(candidates, key=Pwords)
+    return segment_many([text], L)[0]
+
+
+def segment_many(texts, L=20):
+    """Return the best segmentation of each of `texts`, maximizing the sum of the words' log10
+        Pw(). The Pw() lookups for all the texts are done in one batch.
+    """
+    uni = word_scores(texts, L)
+    segmentations = []
+    for text in texts:
+        n = len(text)
+        # best[j] = (log P, end of first word) of the best segmentation of text[j:]
+        best = [None] * n + [(0.0, n)]
+        for j in range(n - 1, -1, -1):
+            best_j = None
+            for i in range(j + 1, min(j + L, n) + 1):
+                score = uni[text[j:i]][0] + best[i][0]
+                if best_j is None or score > best_j[0]:
+                    best_j = score, i
+            best[j] = best_j
+        words = []
+        j = 0
+        while j < n:
+            i = best[j][1]
+            words.append(text[j:i])
+            j = i
+        segmentations.append(words)
+    return segmentations
 
 
 def splits(text, L=20):
@@ -62,20 +151,137 @@ def product(nums):
     return reduce(operator.mul, nums, 1)
 
 
-class Pdist(dict):
-    "A probability distribution estimated from counts in datafile."
+class Pdist:
+    """A probability distribution estimated from counts in datafile.
+        The keys are stored as a sorted array of fixed width UTF-8 byte strings with a parallel
+        array of counts, so lookups are binary searches and many keys can be looked up at once.
+        Pdist.load() memory maps the arrays from files built from a counts file.
+    """
 
-    def __init__(self, data=[], N=None, missingfn=None):
-        for key, count in data:
-            self[key] = self.get(key, 0) + int(count)
-        self.N = float(N or sum(self.itervalues()))
+    def __init__(self, data=[], N=None, missingfn=None, keys=None, counts=None):
+        if keys is None:
+            key_count = defaultdict(int)
+            for key, count in data:
+                key_count[key] += int(count)
+            keys, counts = sorted_arrays(key_count)
+        self.keys = keys
+        self.counts = counts
+        self.width = keys.dtype.itemsize
+        self.N = float(N or self.counts.sum())
         self.missingfn = missingfn or (lambda k, N: 1. / N / N)
 
+    @classmethod
+    def load(cls, name, N=None, missingfn=None):
+        """Returns: Pdist of the counts in `name`, memory mapped from the arrays saved by
+            save_arrays(), which are rebuilt if they are missing or older than `name`
+        """
+        keys_path, counts_path = array_paths(name)
+        if not all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(name)
+                   for path in (keys_path, counts_path)):
+            save_arrays(name)
+        keys = np.load(keys_path, mmap_mode='r')
+        counts = np.load(counts_path, mmap_mode='r')
+        return cls(N=N, missingfn=missingfn, keys=keys, counts=counts)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, words):
+        """Returns: counts of `words`, boolean array that is True for words that are in self"""
+        if not len(self.keys) or not len(words):
+            return np.zeros(len(words), dtype=np.int64), np.zeros(len(words), dtype=bool)
+        query = np.array([w.encode('utf-8') for w in words], dtype=bytes)
+        fits = None
+        if query.dtype.itemsize > self.width:
+            # Keys longer than the longest key in self are not in self. Truncating them could
+            # make them match a shorter key
+            fits = np.char.str_len(query) <= self.width
+            query = query.astype(self.keys.dtype)
+        idx = np.searchsorted(self.keys, query)
+        idx[idx == len(self.keys)] = 0
+        found = self.keys[idx] == query
+        if fits is not None:
+            found &= fits
+        return np.where(found, self.counts[idx], 0), found
+
+    def index(self, key):
+        """Returns: index of `key` in self.keys, -1 if it is not in self"""
+        b = key.encode('utf-8')
+        if len(b) > self.width:
+            return -1
+        i = int(self.keys.searchsorted(b))
+        if i < len(self.keys) and self.keys[i] == b:
+            return i
+        return -1
+
+    def __contains__(self, key):
+        return self.index(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.index(key)
+        if i < 0:
+            raise KeyError(key)
+        return int(self.counts[i])
+
+    def get(self, key, default=None):
+        i = self.index(key)
+        return int(self.counts[i]) if i >= 0 else default
+
+    def probs(self, words):
+        """Returns: array of the probabilities of `words`"""
+        counts, found = self.lookup(words)
+        probs = counts / self.N
+        for i in np.flatnonzero(~found):
+            probs[i] = self.missingfn(words[i], self.N)
+        return probs
+
     def __call__(self, key):
-        if key in self:
-            return self[key] / self.N
-        else:
-            return self.missingfn(key, self.N)
+        """Returns: probability of `key`, or an array of probabilities if `key` is a list of keys"""
+        if isinstance(key, str):
+            i = self.index(key)
+            if i < 0:
+                return self.missingfn(key, self.N)
+            return float(self.counts[i]) / self.N
+        return self.probs(list(key))
+
+
+def sorted_arrays(key_count):
+    """Returns: sorted fixed width UTF-8 key array and int64 count array of dict `key_count`"""
+    encoded = sorted(k.encode('utf-8') for k in key_count)
+    width = max((len(b) for b in encoded), default=1)
+    keys = np.array(encoded, dtype='S%d' % width)
+    counts = np.array([key_count[b.decode('utf-8')] for b in encoded], dtype=np.int64)
+    return keys, counts
+
+
+def array_paths(name):
+    base = os.path.splitext(name)[0]
+    return '%s.keys.npy' % base, '%s.counts.npy' % base
+
+
+def save_arrays(name, sep='\t'):
+    """Build the key and count arrays for counts file `name` and save them to the array_paths()"""
+    key_count = defaultdict(int)
+    for key, count in datafile(name, sep):
+        key_count[key] += int(count)
+    keys, counts = sorted_arrays(key_count)
+    for path, arr in zip(array_paths(name), (keys, counts)):
+        save_array(path, arr)
+
+
+def save_array(path, arr):
+    """Save `arr` to .npy file `path` through a temporary file that is unique to this process, so
+        that processes that save the same array at the same time don't see partial files
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path), suffix='.tmp',
+                                     dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
 
 def datafile(name, sep='\t'):
@@ -90,10 +296,92 @@ def avoid_long_words(key, N):
     return 10. / (N * 20**len(key))
 
 
+class LazyPdist:
+    """A Pdist that is loaded from counts file `name` the first time it is used, so importing
+        this module is cheap. The tables are memory mapped so forked worker processes share one
+        copy of them. Call load() before forking to have the workers inherit the loaded Pdist.
+    """
+
+    def __init__(self, name, N=None, missingfn=None):
+        self.name = os.path.abspath(name)
+        self.pdist_args = N, missingfn
+        self.pdist = None
+
+    def load(self):
+        if self.pdist is None:
+            if ngrams_load == 'text':
+                self.pdist = Pdist(datafile(self.name), *self.pdist_args)
+            else:
+                self.pdist = Pdist.load(self.name, *self.pdist_args)
+        return self.pdist
+
+    def __getstate__(self):
+        # Pickled copies load the tables themselves rather than carrying them along
+        return {'name': self.name, 'pdist_args': self.pdist_args, 'pdist': None}
+
+    def __getattr__(self, attr):
+        # copy and pickle look up dunder methods on objects whose __init__ hasn't run
+        if attr.startswith('__') or 'pdist' not in self.__dict__:
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def __call__(self, key):
+        return self.load()(key)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __len__(self):
+        return len(self.load())
+
+
 N = 1024908267229  # Number of tokens
 
-Pw = Pdist(datafile('count_1w.txt'), N, avoid_long_words)
-P2w = Pdist(datafile('count_2w.txt'), N)
+# 'lazy': load the tables on first use. 'eager': load them at import. 'text': parse the counts files
+# at import, as this module used to.
+ngrams_load = os.environ.get('NGRAMS_LOAD', 'lazy')
+
+Pw = LazyPdist('count_1w.txt', N, avoid_long_words)
+P2w = LazyPdist('count_2w.txt', N)
+if ngrams_load != 'lazy':
+    Pw.load()
+    P2w.load()
+
+
+def import_benchmark(module='clean', n_runs=5):
+    """Time importing `module` and its first Pw() call in fresh processes for each NGRAMS_LOAD
+        setting
+    """
+    import subprocess
+    import sys
+    code = '\n'.join([
+        'import time',
+        't0 = time.perf_counter()',
+        'import %s' % module,
+        't1 = time.perf_counter()',
+        'from ngrams import Pw',
+        'Pw("the")',
+        't2 = time.perf_counter()',
+        'print(t1 - t0, t2 - t1)',
+    ])
+    Pw.load()  # Build the arrays so that no run includes that
+    P2w.load()
+    for mode in ('text', 'eager', 'lazy'):
+        env = dict(os.environ, NGRAMS_LOAD=mode)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                          os.environ.get('PYTHONPATH')]))
+        times = []
+        for _ in range(n_runs):
+            out = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE,
+                                 check=True).stdout
+            times.append([float(t) for t in out.split()[-2:]])
+        import_time = min(t[0] for t in times)
+        use_time = min(t[1] for t in times)
+        print('import_benchmark: %-5s import %s %6.3f sec first Pw() %6.3f sec total %6.3f sec' % (
+              mode, module, import_time, use_time, import_time + use_time))
 
 #### segment2: second version, with bigram counts, (p. 226-227)
 
@@ -174,6 +462,79 @@ def rank_score(ranks):
 
 
 def best_cpt_join(cpts, do_mean):
+    """Return the join of `cpts` with the best score(): the highest lowest word log probability,
+        then the highest sum (or mean if `do_mean`) of the word log probabilities, then the
+        greatest list of words. This is the join best_cpt_join_exhaustive() returns, found by
+        dynamic programming over the fragment boundaries rather than scoring all
+        O(2^len(cpts)) joins. Each best_total() is O(len(cpts)^2) for sums and O(len(cpts)^3)
+        for means. The word by word reconstruction calls it up to len(cpts)^2 times as its sums
+        depend on the words already chosen, so the total is O(len(cpts)^4) for sums and
+        O(len(cpts)^5) for means.
+    """
+    n = len(cpts)
+    if not n:
+        return []
+    # logp[j][i] = log10 Pw(''.join(cpts[j:i]))
+    words = [''.join(cpts[j:i]) for j in range(n) for i in range(j + 1, n + 1)]
+    probs = iter(Pw(words).tolist())
+    logp = [[None] * (n + 1) for _ in range(n)]
+    for j in range(n):
+        for i in range(j + 1, n + 1):
+            p = next(probs)
+            logp[j][i] = log10(p) if p > 0 else float('-inf')
+
+    # The best lowest word log probability. min() and max() are exact so this is a plain DP
+    low = [float('inf')] + [None] * n
+    for i in range(1, n + 1):
+        low[i] = max(min(low[j], logp[j][i]) for j in range(i))
+    floor = low[n]
+
+    def best_total(start, total, n_words):
+        """The best sum (or mean) of a join of cpts[:n] that starts with a join of cpts[:start] with
+            sum `total` of `n_words` words, and has no words below `floor`. Sums are accumulated
+            left to right as score() does so they are exactly equal to score()'s.
+        """
+        if not do_mean:
+            best = [None] * (n + 1)
+            best[start] = total
+            for i in range(start + 1, n + 1):
+                best[i] = max((best[j] + logp[j][i] for j in range(start, i)
+                               if best[j] is not None and logp[j][i] >= floor), default=None)
+            return best[n]
+        # best[i] = {number of words: best sum}
+        best = [{} for _ in range(n + 1)]
+        best[start][n_words] = total
+        for i in range(start + 1, n + 1):
+            for j in range(start, i):
+                if logp[j][i] < floor:
+                    continue
+                for k, t in best[j].items():
+                    t += logp[j][i]
+                    if best[i].get(k + 1, t) <= t:
+                        best[i][k + 1] = t
+        return max((t / k for k, t in best[n].items()), default=None)
+
+    target = best_total(0, 0, 0)
+
+    # Of the joins with the best score, the greatest list of words is found by taking the longest
+    # possible word at each step, as the candidates for each word are prefixes of one string
+    join = []
+    j = 0
+    total = 0
+    while j < n:
+        for i in range(n, j, -1):
+            if logp[j][i] >= floor and best_total(i, total + logp[j][i], len(join) + 1) == target:
+                break
+        join.append(''.join(cpts[j:i]))
+        total += logp[j][i]
+        j = i
+    return join
+
+
+def best_cpt_join_exhaustive(cpts, do_mean):
+    """Return the join of `cpts` with the best score(). Scores all 2^(len(cpts)-1) joins.
+        The original version of best_cpt_join.
+    """
     # print('best_cpt_join', len(cpts), cpts)
 
     joins = cpt_joins(cpts)
@@ -201,19 +562,20 @@ def best_cpt_join(cpts, do_mean):
     return ret
 
 
-def segment_cpts_recursive(cpts, L=5, do_mean=False):
-    "Return (log P(words), words), where words is the best segmentation."
+def segment_cpts_recursive(cpts, L=5, do_mean=False, join=best_cpt_join):
+    """Return (log P(words), words), where words is the best segmentation.
+        Each window of `L` fragments is replaced by its best join as given by `join`.
+    """
     assert isinstance(cpts, list), type(cpts)
 
     L = min(len(cpts) - 1, L)
 
     i = 0
     # print('%3d: %10g: %s' % (i, score(cpts), cpts[max(i - L, 0): i + L]))
-    cpts_new = []
+    cpts = list(cpts)  # Updated in place below
     while i <= len(cpts) - L:
         n = len(cpts)
-        cpts1 = best_cpt_join(cpts[i:i + L], do_mean=do_mean)
-        cpts = cpts[:i] + cpts1 + cpts[i + L:]
+        cpts[i:i + L] = join(cpts[i:i + L], do_mean)
         # print(cpts1)
         # print('%3d: %10g: %s' % (i, score(cpts), cpts[max(i - L, 0): i + L]))
         if n == len(cpts) or True:
@@ -245,26 +607,203 @@ if False:
     assert False
 
 
+def broken_fragments(text, seed=0):
+    """Returns: the words of `text` with some of them broken into fragments, like OCR output"""
+    rand = random.Random(seed)
+    cpts = []
+    for word in text.split():
+        while len(word) > 1 and rand.random() < 0.3:
+            i = rand.randint(1, len(word) - 1)
+            cpts.append(word[:i])
+            word = word[i:]
+        cpts.append(word)
+    return cpts
+
+
+def cpt_join_benchmark(n_words=2000, Ls=(3, 5, 8, 11)):
+    """Time segment_cpts_recursive with best_cpt_join and best_cpt_join_exhaustive on a page length
+        list of fragments.
+    """
+    text = ('Reducing printing by finding classes of documents that should not be printed or could '
+            'be printed differently double sided two pages per sheet bw instead of colour ')
+    words = text.split()
+    text = ' '.join(words[i % len(words)] for i in range(n_words))
+    cpts = broken_fragments(text)
+    for L in Ls:
+        for do_mean in (False, True):
+            t0 = time.perf_counter()
+            joined = segment_cpts_recursive(cpts, L, do_mean)
+            t1 = time.perf_counter()
+            if L <= 8:
+                joined_exhaustive = segment_cpts_recursive(cpts, L, do_mean, best_cpt_join_exhaustive)
+                assert joined == joined_exhaustive, (L, do_mean)
+                exhaustive = '%7.2f sec' % (time.perf_counter() - t1)
+            else:
+                exhaustive = '      -    '
+            print('cpt_join_benchmark: %d fragments L=%2d do_mean=%-5s dp=%6.2f sec exhaustive=%s' % (
+                  len(cpts), L, do_mean, t1 - t0, exhaustive))
+
+
 def combine(Pfirst, first, Prem_rem):
     "Combine first and rem results into one (probability, words) pair."
     Prem, rem = Prem_rem
     return Pfirst + Prem, [first] + rem
 
 
+def word_scores(texts, L=20, prevs=()):
+    """Look up every substring of up to `L` characters of `texts`, and the words in `prevs`, in
+        Pw in one batch.
+        Returns: {word: (log10 Pw(word), count of word in Pw or None if it is not in Pw)}
+    """
+    words = set(prevs)
+    for text in texts:
+        n = len(text)
+        for j in range(n):
+            for i in range(j + 1, min(j + L, n) + 1):
+                words.add(text[j:i])
+    words = list(words)
+    counts, found = Pw.lookup(words)
+    N = Pw.N
+    missingfn = Pw.missingfn
+    scores = {}
+    for word, count, ok in zip(words, counts.tolist(), found.tolist()):
+        if ok:
+            scores[word] = log10(count / N), count
+        else:
+            scores[word] = log10(missingfn(word, N)), None
+    return scores
+
+
+def bigram_scores(text, uni, prev0, lo, hi, L=20):
+    """Look up the bigrams that segment2 needs for the words starting at offsets `lo` to `hi` of
+        `text` in P2w in one batch. cPw(word, prev) only uses P2w when prev is in Pw, so only those
+        bigrams are looked up. `prev0` is the word before the start of `text`.
+        Returns: {(prev, word): log10 cPw(word, prev)} for the bigrams that are in P2w
+    """
+    n = len(text)
+    pairs = set()
+    for j in range(lo, hi):
+        prevs_j = [text[k:j] for k in range(max(j - L, 0), j)]
+        if j == 0:
+            prevs_j.append(prev0)
+        prevs_j = [prev for prev in prevs_j if uni[prev][1] is not None]
+        if not prevs_j:
+            continue
+        for i in range(j + 1, min(j + L, n) + 1):
+            word = text[j:i]
+            for prev in prevs_j:
+                pairs.add((prev, word))
+    pairs = list(pairs)
+    counts, found = P2w.lookup(['%s %s' % pair for pair in pairs])
+    scores = {}
+    for pair, count, ok in zip(pairs, counts.tolist(), found.tolist()):
+        if ok:
+            scores[pair] = log10(count / float(uni[pair[0]][1]))
+    return scores
+
+
+def segment2(text, prev='<S>', L=20):
+    "Return (log P(words), words), where words is the best segmentation."
+    return segment2_many([text], prev, L)[0]
+
+
+def segment2_many(texts, prev='<S>', L=20):
+    """Return segment2(text, `prev`) for each of `texts`. The Pw lookups for all the texts are
+        done in one batch. viterbi2 looks up the P2w bigrams `bigram_window` offsets at a time.
+    """
+    uni = word_scores(texts, L, [prev])
+    return [viterbi2(text, prev, uni, L) for text in texts]
+
+
+def viterbi2(text, prev, uni, L):
+    """The best segmentation of `text` following word `prev`, under the bigram model cPw.
+        This is segment2_recursive computed iteratively from the end of `text`.
+
+        The state at offset j is the previous word. cPw(word, prev) is Pw(word) for all prev that
+        are not in Pw, so they share one state, unknown[j]. Previous words text[k:j] that are in Pw
+        have their own states, known[(k, j)]. `start` is the state of `prev` at offset 0.
+        Each state is (log P, end of first word, state at that end) of the best segmentation of
+        text[j:], with scores summed in the same order as segment2_recursive and ties broken the
+        same way.
+        The bigrams are looked up for `bigram_window` offsets at a time, so memory is bounded by
+        bigram_window * L * L pairs rather than growing with the length of `text`.
+        Returns: log P, words
+    """
+    n = len(text)
+    if not n:
+        return 0.0, []
+    end = (0.0, n, None)
+    unknown = [None] * n + [end]
+    known = {}
+
+    def next_state(j, i):
+        "State at offset i after word text[j:i]"
+        if i == n:
+            return end
+        if uni[text[j:i]][1] is None:
+            return unknown[i]
+        return known[(j, i)]
+
+    def words_of(j, state):
+        words = []
+        while j < n:
+            _, i, state = state
+            words.append(text[j:i])
+            j = i
+        return words
+
+    def best_state(j, prev):
+        """Returns: best state for text[j:] after word `prev`, None for unknown[j]"""
+        use_bigrams = prev is not None and uni[prev][1] is not None
+        best = None
+        for i in range(j + 1, min(j + L, n) + 1):
+            word = text[j:i]
+            score = uni[word][0]
+            if use_bigrams:
+                score = bi.get((prev, word), score)
+            after = next_state(j, i)
+            state = score + after[0], i, after
+            # segment2_recursive breaks ties by comparing the word lists. Their first words are
+            # text[j:i] for different i, so the list with the longer first word, later here, wins
+            if best is None or state[0] >= best[0]:
+                best = state
+        return best
+
+    for hi in range(n, 0, -bigram_window):
+        lo = max(hi - bigram_window, 0)
+        bi = bigram_scores(text, uni, prev, lo, hi, L)
+        for j in range(hi - 1, lo - 1, -1):
+            unknown[j] = best_state(j, None)
+            for k in range(max(j - L, 0), j):
+                if uni[text[k:j]][1] is not None:
+                    known[(k, j)] = best_state(j, text[k:j])
+    start = best_state(0, prev) if uni[prev][1] is not None else unknown[0]
+    return start[0], words_of(0, start)
+
+
 depth = 0
 depth_dict = defaultdict(int)
 
 
-@memo
-def segment2(text, prev='<S>'):
-    "Return (log P(words), words), where words is the best segmentation."
+def segment2_recursive(text, prev='<S>'):
+    """Return (log P(words), words), where words is the best segmentation.
+        The original recursive version of segment2. Its recursion depth is the number of words
+        in `text`, so it can only be used on short texts.
+    """
+    segment2_suffix.cache_clear()
+    return segment2_suffix(text, prev)
+
+
+@memo(key=suffix_key)
+def segment2_suffix(text, prev):
+    "segment2_recursive of `text`, a suffix of the text it was called with"
     global depth, depth_dict
 
     if not text:
         return 0.0, []
     depth += 1
-    depth_dict[depth] += v1
-    candidates = [combine(log10(cPw(first, prev)), first, segment2(rem, first))
+    depth_dict[depth] += 1
+    candidates = [combine(log10(cPw(first, prev)), first, segment2_suffix(rem, first))
                   for first, rem in splits(text)]
     # print('>>>', depth, text, prev, max(candidates))
     depth -= 1
@@ -272,11 +811,19 @@ def segment2(text, prev='<S>'):
 
 
 if __name__ == '__main__':
+    import sys
+    if '--import-benchmark' in sys.argv:
+        import_benchmark()
+        sys.exit()
+    if '--cpt-benchmark' in sys.argv:
+        cpt_join_benchmark()
+        sys.exit()
     text = "p rinting by finding c lasses"
     text = text.replace(' ', '')
     print('text=%d %s' % (len(text), text))
-    text = segment2(text)
-    print(text)
+    print(segment2(text))
+    print(segment2_recursive(text))
+    memo_stats()
     for depth in sorted(depth_dict):
         print('%3d: %2d' % (depth, depth_dict[depth]))
 
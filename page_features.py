@@ -0,0 +1,207 @@
+"""
+    Page feature table for blank page heuristics
+
+    One row per page of every summary in a corpus created by make_page_corpus.py, stored as
+    NumPy column arrays so the blank page heuristics in detect_blank_pages.py can run as array
+    operations over the whole corpus.
+"""
+import os
+import re
+import time
+import numpy as np
+from utils_peter import summary_dir, base_name
+from summary_store import load_summary, summary_paths
+from detect_blank_pages import is_page_number, find_watermark_pages
+
+
+FEATURES_NAME = 'page_features.npz'  # Feature table file in the summary directory
+SUMMARY_FIELDS = ['page_summaries', 'page_texts', 'marked_text', 'marked_graph']
+
+# Column name: dtype
+COLUMNS = {
+    'doc': np.int32,           # Index of document in `names`
+    'page': np.int32,          # Page number in document. Starts at 0
+    'n_chars': np.int32,
+    'n_lines': np.int32,
+    'page_number': np.bool_,   # Page text is only a page number
+    'left_blank': np.bool_,    # Page text says it is intentionally blank
+    'watermark': np.bool_,     # Page text is only the document's watermark
+    'marked_text': np.bool_,   # pdf_page_summaries found text marks on the page
+    'marked_graph': np.bool_,  # pdf_page_summaries found non-text marks on the page
+}
+
+RE_LEFT_BLANK = re.compile(r'\bintentionally\s+(?:been\s+)?(?:left\s+)?blank\b', re.IGNORECASE)
+
+
+def none2empty(a):
+    if a is None:
+        return []
+    return a
+
+
+def doc_features(summary, min_len, max_len):
+    """Returns: {column: list of values} for the pages in `summary` (without 'doc')"""
+    page_texts = summary['page_texts']
+    n = len(page_texts)
+    page_summaries = summary.get('page_summaries') or [
+        {'n_chars': len(text), 'n_lines': len(text.split('\n'))} for text in page_texts]
+    indexes_watermark, _ = find_watermark_pages(page_texts, min_len, max_len)
+    watermark = set(indexes_watermark)
+
+    if 'marked_text' in summary:
+        # pdf_page_summaries page numbers start at 1
+        marked_text = {p - 1 for p in none2empty(summary['marked_text'])}
+        marked_graph = {p - 1 for p in none2empty(summary['marked_graph'])}
+    else:
+        # No mark information. Assume every page has text and graphics so that no page is
+        # blank for lack of marks
+        marked_text = marked_graph = set(range(n))
+
+    return {
+        'page': list(range(n)),
+        'n_chars': [s['n_chars'] for s in page_summaries],
+        'n_lines': [s['n_lines'] for s in page_summaries],
+        'page_number': [is_page_number(text) for text in page_texts],
+        'left_blank': [RE_LEFT_BLANK.search(text) is not None for text in page_texts],
+        'watermark': [i in watermark for i in range(n)],
+        'marked_text': [i in marked_text for i in range(n)],
+        'marked_graph': [i in marked_graph for i in range(n)],
+    }
+
+
+def build_page_features(root, min_len=5, max_len=200, max_files=-1):
+    """Build the page feature table for the summaries in directory `root`
+        Returns: names, {column: array}
+            names: document names. features['doc'] indexes this list
+    """
+    path_list = summary_paths(root)
+    if max_files > 0:
+        path_list = path_list[:max_files]
+    t0 = time.perf_counter()
+    names = []
+    columns = {column: [] for column in COLUMNS}
+    for i, path in enumerate(path_list):
+        summary = load_summary(path, SUMMARY_FIELDS)
+        if 'page_texts' not in summary:
+            continue
+        values = doc_features(summary, min_len, max_len)
+        columns['doc'].extend([len(names)] * len(values['page']))
+        for column, vals in values.items():
+            columns[column].extend(vals)
+        names.append(base_name(path))
+    features = {column: np.array(vals, dtype=COLUMNS[column]) for column, vals in columns.items()}
+    print('build_page_features: %d docs %d pages %.1f sec' % (len(names), len(features['doc']),
+          time.perf_counter() - t0))
+    return names, features
+
+
+def corpus_state(root, min_len, max_len):
+    """Returns: paths and mtimes of the summaries in directory `root` and the build_page_features
+        parameters [min_len, max_len]. The feature table is rebuilt when any of these change.
+    """
+    path_list = summary_paths(root)
+    return path_list, [os.stat(path).st_mtime_ns for path in path_list], [min_len, max_len]
+
+
+def save_page_features(path, names, features, state):
+    paths, mtimes, params = state
+    np.savez(path, _names=np.array(names, dtype=str), _paths=np.array(paths, dtype=str),
+             _mtimes=np.array(mtimes, dtype=np.int64), _params=np.array(params, dtype=np.int64),
+             **features)
+
+
+def features_current(path, state):
+    """Returns: True if the feature table in `path` was built from the summaries and with the
+        parameters in `state`
+    """
+    if not os.path.exists(path):
+        return False
+    paths, mtimes, params = state
+    with np.load(path) as data:
+        if '_paths' not in data.files or '_params' not in data.files:
+            return False
+        return (data['_params'].tolist() == params and data['_paths'].tolist() == paths and
+                data['_mtimes'].tolist() == mtimes)
+
+
+def load_page_features(path):
+    """Returns: names, features as returned by build_page_features"""
+    with np.load(path) as data:
+        names = list(data['_names'])
+        features = {column: data[column] for column in COLUMNS}
+    return names, features
+
+
+def blank_masks(features):
+    """Evaluate the blank page heuristics over all pages at once
+        Returns: {heuristic: boolean array with one entry per page}
+    """
+    text_only = features['marked_text'] & ~features['marked_graph']
+    no_marks = ~features['marked_text'] & ~features['marked_graph']
+    empty = features['n_chars'] == 0
+    masks = {
+        'no_marks': no_marks,
+        'empty': text_only & empty,
+        'page_number': text_only & features['page_number'],
+        'left_blank': text_only & features['left_blank'],
+        'watermark': text_only & features['watermark'],
+    }
+    blank = np.zeros_like(no_marks)
+    for mask in masks.values():
+        blank |= mask
+    masks['blank'] = blank
+    return masks
+
+
+def pages_by_doc(names, features, mask):
+    """Returns: {name: [page numbers]} for the pages selected by boolean array `mask`"""
+    selected = np.flatnonzero(mask)
+    docs = features['doc'][selected]
+    pages = features['page'][selected]
+    doc_pages = {}
+    for doc, pages_doc in zip(*group_by(docs, pages)):
+        doc_pages[names[doc]] = pages_doc.tolist()
+    return doc_pages
+
+
+def group_by(keys, values):
+    """Split `values` into groups of equal `keys`. `keys` must be sorted
+        Returns: unique keys, list of value arrays
+    """
+    if not len(keys):
+        return [], []
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.split(values, starts[1:])
+
+
+def find_blank_pages_corpus(root, rebuild=False, min_len=5, max_len=200):
+    """Report the blank pages in the corpus in directory `root` using the page feature table in
+        `root`, which is built if it is missing or the summaries or `min_len` or `max_len` have
+        changed.
+        Returns: {name: [blank page numbers]}
+    """
+    features_path = os.path.join(root, FEATURES_NAME)
+    state = corpus_state(root, min_len, max_len)
+    if rebuild or not features_current(features_path, state):
+        names, features = build_page_features(root, min_len, max_len)
+        save_page_features(features_path, names, features, state)
+    else:
+        names, features = load_page_features(features_path)
+
+    t0 = time.perf_counter()
+    masks = blank_masks(features)
+    doc_blanks = pages_by_doc(names, features, masks['blank'])
+    dt = time.perf_counter() - t0
+    print('find_blank_pages_corpus: %d docs %d pages %.3f sec' % (len(names), len(features['doc']),
+          dt))
+    for heuristic, mask in masks.items():
+        print('%12s: %7d pages %5d docs' % (heuristic, mask.sum(),
+              len(np.unique(features['doc'][mask]))))
+    return doc_blanks
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = [arg for arg in sys.argv[1:] if arg != '--rebuild']
+    find_blank_pages_corpus(args[0] if args else summary_dir, rebuild='--rebuild' in sys.argv)
@@ -0,0 +1,175 @@
+"""
+    Corpus wide page index
+
+    An SQLite database with one row per page of every summary in a corpus created by
+    make_page_corpus.py. Pages are indexed by (n_chars, n_lines) and (n_lines, n_chars) so
+    queries like "all pages with fewer than 50 characters" don't need to load the corpus.
+    make_page_corpus.py adds each summary as it is written. update_index() catches up with
+    summaries that were written some other way.
+
+    Only the first PREFIX_LEN characters of each page's text are stored, with newlines replaced by
+    spaces, to keep the index small. query_pages() reads longer texts from the summaries and
+    page_text() returns the full text of one page.
+"""
+import os
+import sqlite3
+from functools import lru_cache
+from utils_peter import base_name
+from summary_store import load_summary, summary_paths
+
+
+PAGE_INDEX_NAME = 'page_index.sqlite'
+PREFIX_LEN = 200  # Number of characters of each page's text that are stored
+text_cache_docs = 100  # Summaries whose page texts query_pages keeps loaded for prefix_len > PREFIX_LEN
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    name TEXT PRIMARY KEY,
+    path TEXT,
+    mtime_ns INTEGER,
+    n_pages INTEGER
+);
+CREATE TABLE IF NOT EXISTS pages (
+    name TEXT,
+    page INTEGER,
+    n_chars INTEGER,
+    n_lines INTEGER,
+    text TEXT,
+    PRIMARY KEY (name, page)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pages_chars ON pages (n_chars, n_lines, name, page);
+CREATE INDEX IF NOT EXISTS pages_lines ON pages (n_lines, n_chars, name, page);
+'''
+
+ORDERS = {
+    'n_chars': 'n_chars, n_lines, name, page',
+    'n_lines': 'n_lines, n_chars, name, page',
+    'name': 'name, page',
+}
+
+
+def index_path(root):
+    return os.path.join(root, PAGE_INDEX_NAME)
+
+
+def open_index(path):
+    """Open the page index database `path`, creating it if necessary"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def index_summary(conn, summary_path):
+    """Add the pages of summary `summary_path` to the index `conn`, replacing any existing pages
+        for the same document.
+    """
+    summary = load_summary(summary_path, ['page_summaries', 'page_texts'])
+    name = base_name(summary_path)
+    page_summaries = summary.get('page_summaries', [])
+    page_texts = summary.get('page_texts', [])
+    rows = [(name, i, s['n_chars'], s['n_lines'], text[:PREFIX_LEN].replace('\n', ' '))
+            for i, (s, text) in enumerate(zip(page_summaries, page_texts))]
+    with conn:
+        conn.execute('DELETE FROM pages WHERE name = ?', (name,))
+        conn.executemany('INSERT INTO pages VALUES (?, ?, ?, ?, ?)', rows)
+        conn.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)',
+                     (name, summary_path, os.stat(summary_path).st_mtime_ns, len(rows)))
+
+
+def remove_doc(conn, name):
+    with conn:
+        conn.execute('DELETE FROM pages WHERE name = ?', (name,))
+        conn.execute('DELETE FROM docs WHERE name = ?', (name,))
+
+
+def update_index(conn, root, max_files=-1):
+    """Bring the index `conn` up to date with the summaries in directory `root`: index new and
+        changed summaries and remove deleted ones.
+        Returns: number of summaries indexed
+    """
+    path_list = summary_paths(root)
+    if max_files > 0:
+        path_list = path_list[:max_files]
+    indexed = {name: (path, mtime_ns) for name, path, mtime_ns in
+               conn.execute('SELECT name, path, mtime_ns FROM docs')}
+    n_indexed = 0
+    current = set()
+    for path in path_list:
+        name = base_name(path)
+        current.add(name)
+        if indexed.get(name) == (path, os.stat(path).st_mtime_ns):
+            continue
+        index_summary(conn, path)
+        n_indexed += 1
+    if max_files <= 0:
+        for name in set(indexed) - current:
+            remove_doc(conn, name)
+    n_docs, = conn.execute('SELECT COUNT(*) FROM docs').fetchone()
+    n_pages, = conn.execute('SELECT COUNT(*) FROM pages').fetchone()
+    print('update_index: %d summaries %d indexed. index has %d docs %d pages' % (len(path_list),
+          n_indexed, n_docs, n_pages))
+    return n_indexed
+
+
+def page_text(conn, name, page):
+    """Returns: the full text of page `page` of document `name` in index `conn`, read from its
+        summary
+    """
+    row = conn.execute('SELECT path FROM docs WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        raise KeyError(name)
+    return load_summary(row[0], ['page_texts'])['page_texts'][page]
+
+
+def query_pages(conn, max_chars=None, max_lines=None, min_chars=None, min_lines=None,
+                order='n_chars', prefix_len=PREFIX_LEN, names=None):
+    """Generate the pages in index `conn` with n_chars and n_lines in the given ranges
+        (inclusive) in `order` ('n_chars', 'n_lines' or 'name'), of the documents in `names` if
+        it isn't None.
+        e.g. query_pages(conn, max_chars=49) for all pages under 50 chars
+        Yields: page info dicts with keys _name, _page, n_chars, n_lines, text
+            text: the first `prefix_len` characters of the page with newlines replaced by spaces.
+            Prefixes longer than PREFIX_LEN are read from the summaries.
+    """
+    where = []
+    args = []
+    for column, op, value in [('n_chars', '<=', max_chars), ('n_lines', '<=', max_lines),
+                              ('n_chars', '>=', min_chars), ('n_lines', '>=', min_lines)]:
+        if value is not None:
+            where.append('%s %s ?' % (column, op))
+            args.append(value)
+    if names is not None:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS query_names (name TEXT PRIMARY KEY)')
+        with conn:
+            conn.execute('DELETE FROM query_names')
+            conn.executemany('INSERT OR IGNORE INTO query_names VALUES (?)', ((n,) for n in names))
+        where.append('name IN (SELECT name FROM query_names)')
+    sql = 'SELECT name, page, n_chars, n_lines, substr(text, 1, ?) FROM pages'
+    if where:
+        sql += ' WHERE %s' % ' AND '.join(where)
+    sql += ' ORDER BY %s' % ORDERS[order]
+
+    @lru_cache(maxsize=text_cache_docs)
+    def doc_texts(name):
+        return load_summary(doc_paths[name], ['page_texts']).get('page_texts', [])
+
+    if prefix_len > PREFIX_LEN:
+        doc_paths = dict(conn.execute('SELECT name, path FROM docs'))
+    for name, page, n_chars, n_lines, text in conn.execute(sql, [prefix_len] + args):
+        if prefix_len > PREFIX_LEN and len(text) == PREFIX_LEN:
+            text = doc_texts(name)[page][:prefix_len].replace('\n', ' ')
+        yield {'_name': name, '_page': page, 'n_chars': n_chars, 'n_lines': n_lines, 'text': text}
+
+
+if __name__ == '__main__':
+    import sys
+    from utils_peter import summary_dir
+
+    root = sys.argv[1] if len(sys.argv) > 1 else summary_dir
+    max_chars = int(sys.argv[2]) if len(sys.argv) > 2 else 49
+    conn = open_index(index_path(root))
+    update_index(conn, root)
+    for i, info in enumerate(query_pages(conn, max_chars=max_chars)):
+        print('%6d: %4d l %5d c - %-30s "%s"' % (i, info['n_lines'], info['n_chars'],
+              (info['_name'], info['_page']), info['text']))
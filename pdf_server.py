@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+"""
+    Static file server for the PDFs in pdf_dir, for the page URLs in the Prodigy tasks written by
+    to_prodigy.py and doc_to_prodigy.py, e.g. http://localhost:8000/<name>#page=N
+
+    Serves many clients at once with asyncio. Supports HEAD and byte range requests
+    (Range: bytes=a-b, a- or -n) so PDF viewers can fetch only the parts of a PDF they need.
+    File contents are sent with loop.sendfile(), which uses os.sendfile() where it is available.
+
+    <name>?page=N is page N (starting at 1) of <name> as a one page PDF and <name>?page=N&format=png
+    is a PNG of it. Pages are rendered with PdfBox on demand into a size bounded LRU disk cache.
+    When a page is requested, the pages of the next `prefetch_n` tasks in all.pages.jsonl are
+    rendered in the background so that they are ready when the annotator gets to them.
+
+    Usage::
+        ./pdf_server.py [<port>] [<root>]
+"""
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+import asyncio
+import mimetypes
+import tempfile
+from collections import OrderedDict
+from email.utils import formatdate
+from urllib.parse import unquote, urlsplit, parse_qs
+from utils_peter import pdf_dir
+from from_prodigy import RE_URL
+
+
+# Settings
+port = 8000
+root_dir = os.path.expanduser(pdf_dir)
+max_header = 16 * 1024  # Bytes in a request header
+max_body = 64 * 1024    # Bytes of request body discarded to keep a connection open. Larger bodies close it
+keepalive_timeout = 30  # Seconds an idle connection is kept open
+pdfbox_jar = './pdfbox-app-2.0.7.jar'
+cache_dir = 'page_cache'              # Rendered pages
+cache_max_bytes = 1024 * 1024 * 1024  # Size of cache_dir before least recently used pages are removed
+n_renderers = os.cpu_count() or 1     # Pages rendered at once
+render_timeout = 60                   # Seconds allowed to render a page
+render_dpi = 96                       # Resolution of PNG pages
+tasks_path = 'all.pages.jsonl'        # Prodigy tasks, in review order, to prefetch pages for
+prefetch_n = 20                       # Tasks after the one being reviewed to prefetch pages for
+FORMATS = ('pdf', 'png')
+
+RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+    502: 'Bad Gateway',
+    504: 'Gateway Timeout',
+}
+
+
+def resolve_path(root, target):
+    """Returns: path of the file under `root` for request target `target`, or None if the
+        target is outside `root`
+    """
+    path = unquote(urlsplit(target).path)
+    full = os.path.realpath(os.path.join(root, path.lstrip('/')))
+    if full != root and not full.startswith(os.path.join(root, '')):
+        return None
+    return full
+
+
+def parse_range(value, size):
+    """Parse Range header `value` for a file of `size` bytes
+        Returns: (start, end) inclusive byte range, None to send the whole file (missing, multiple
+            or invalid ranges) or False if the range can't be satisfied
+    """
+    if not value:
+        return None
+    m = RE_RANGE.match(value.strip())
+    if not m:
+        return None
+    first, last = m.groups()
+    if not first and not last:
+        return None
+    if not first:
+        n = int(last)  # Suffix range: the last n bytes
+        if n == 0 or size == 0:
+            return False
+        return max(size - n, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None  # Syntactically invalid so the header is ignored
+    if start >= size:
+        return False
+    end = int(last) if last else size - 1
+    return start, min(end, size - 1)
+
+
+class RenderError(Exception):
+    """A page could not be rendered. `status` is the HTTP status to respond with"""
+
+    def __init__(self, message, status=404):
+        super().__init__(message)
+        self.status = status
+
+
+async def run_pdfbox(args):
+    """Run PdfBox command `args` without blocking the event loop
+        Raises: RenderError if it fails
+    """
+    try:
+        process = await asyncio.create_subprocess_exec('java', '-jar', pdfbox_jar, *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        raise RenderError('can\'t run java: %s' % e, 502)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), render_timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RenderError('timeout after %d sec: %s' % (render_timeout, ' '.join(args)), 504)
+    if process.returncode != 0:
+        raise RenderError('%s failed: %s' % (args[0], stderr.decode('utf-8', 'replace')[-500:]))
+
+
+async def render_page(pdf_path, page, fmt, out_path):
+    """Render page `page` (starting at 1) of `pdf_path` in format `fmt` to `out_path`"""
+    with tempfile.TemporaryDirectory(prefix='render.', dir=os.path.dirname(out_path)) as temp_dir:
+        prefix = os.path.join(temp_dir, 'page')
+        if fmt == 'pdf':
+            await run_pdfbox(['PDFSplit', '-startPage', str(page), '-endPage', str(page),
+                              '-outputPrefix', prefix, pdf_path])
+        else:
+            await run_pdfbox(['PDFToImage', '-format', fmt, '-page', str(page),
+                              '-dpi', str(render_dpi), '-outputPrefix', prefix, pdf_path])
+        outputs = glob.glob('%s*.%s' % (glob.escape(prefix), fmt))
+        if len(outputs) != 1:
+            raise RenderError('no page %d in %s' % (page, pdf_path))
+        os.replace(outputs[0], out_path)
+
+
+class PageCache:
+    """Pages rendered by render_page() in directory `root`. When the files in `root` total more
+        than `max_bytes` the least recently used ones are removed. Cache file names are derived
+        from the PDF's path, size and mtime so changed PDFs are rendered again.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.slots = None
+        self.rendering = {}  # {name: asyncio.Task} for pages being rendered
+        self.n_hits = self.n_misses = self.n_evictions = 0
+        os.makedirs(root, exist_ok=True)
+        for entry in os.scandir(root):
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)  # Left by an interrupted render
+        files = [(entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                 for entry in os.scandir(root) if entry.is_file()]
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.n_bytes = sum(self.entries.values())
+
+    def cache_name(self, pdf_path, page, fmt):
+        st = os.stat(pdf_path)
+        key = '%s|%d|%d|%d' % (pdf_path, st.st_size, st.st_mtime_ns, page)
+        return '%s.%s' % (hashlib.sha1(key.encode('utf-8')).hexdigest(), fmt)
+
+    async def get(self, pdf_path, page, fmt):
+        """Returns: path of the cached render of page `page` of `pdf_path` in format `fmt`,
+            rendering it if necessary
+            Raises: RenderError
+        """
+        try:
+            name = self.cache_name(pdf_path, page, fmt)
+        except OSError as e:
+            raise RenderError(str(e))
+        path = os.path.join(self.root, name)
+        if name in self.entries:
+            try:
+                os.utime(path)  # Keep the LRU order across restarts
+            except OSError:
+                # Removed from the cache directory by something else. Render it again
+                self.n_bytes -= self.entries.pop(name)
+            else:
+                self.n_hits += 1
+                self.entries.move_to_end(name)
+                return path
+        task = self.rendering.get(name)
+        if task is None:
+            self.n_misses += 1
+            task = asyncio.ensure_future(self.render(pdf_path, page, fmt, name))
+            self.rendering[name] = task
+        await asyncio.shield(task)
+        return path
+
+    async def render(self, pdf_path, page, fmt, name):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(n_renderers)
+        try:
+            async with self.slots:
+                await render_page(pdf_path, page, fmt, os.path.join(self.root, name))
+            self.add(name)
+        except OSError as e:
+            raise RenderError('%s: %s' % (type(e).__name__, e), 502)
+        finally:
+            del self.rendering[name]
+
+    def add(self, name):
+        size = os.path.getsize(os.path.join(self.root, name))
+        self.entries[name] = size
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            old, old_size = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.root, old))
+            except FileNotFoundError:
+                pass
+            self.n_bytes -= old_size
+            self.n_evictions += 1
+
+
+def load_task_pages(path):
+    """Returns: list of (name, page) of the Prodigy tasks in JSONL file `path`, in file order"""
+    task_pages = []
+    if not os.path.exists(path):
+        return task_pages
+    with open(path, 'r') as f:
+        for line in f:
+            m = RE_URL.search(json.loads(line)['meta']['url'])
+            if m:
+                task_pages.append((m.group(1), int(m.group(2))))
+    return task_pages
+
+
+class Request:
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.close = False  # Set if the connection can't be reused after this request
+
+    def keep_alive(self):
+        if self.close:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+async def read_request(reader):
+    """Returns: the next Request on `reader`, None at end of stream
+        Raises: ValueError for malformed requests
+    """
+    try:
+        data = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise ValueError('incomplete request')
+    except asyncio.LimitOverrunError:
+        raise ValueError('header too large')
+    lines = data.decode('latin-1').split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise ValueError('bad request line: %r' % lines[0])
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError('bad header: %r' % line)
+        headers[name.strip().lower()] = value.strip()
+    request = Request(parts[0], parts[1], parts[2], headers)
+
+    # We never use a request body but it must be read so that it isn't parsed as the next request
+    try:
+        n = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ValueError('bad content-length')
+    if n < 0:
+        raise ValueError('bad content-length')
+    if 'transfer-encoding' in headers or n > max_body:
+        request.close = True
+    elif n:
+        try:
+            await reader.readexactly(n)
+        except asyncio.IncompleteReadError:
+            raise ValueError('incomplete request')
+    return request
+
+
+class PdfServer:
+
+    def __init__(self, root, cache=None, task_pages=None):
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        self.task_pages = task_pages or []
+        self.task_index = {task: i for i, task in enumerate(self.task_pages)}
+        self.n_requests = 0
+        self.n_bytes = 0
+
+    def prefetch(self, name, page):
+        """Start rendering the pages of the `prefetch_n` tasks after page `page` of `name`"""
+        i = self.task_index.get((name, page))
+        if i is None:
+            return
+        for next_name, next_page in self.task_pages[i + 1:i + 1 + prefetch_n]:
+            path = resolve_path(self.root, next_name)
+            if path is None or not os.path.isfile(path):
+                continue
+            task = asyncio.ensure_future(self.cache.get(path, next_page, 'pdf'))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # Reported on request
+
+    async def page_path(self, request, path):
+        """Returns: path of the render requested by the ?page=N query of `request` for `path`,
+            `path` if there is no such query, or an error status
+        """
+        query = parse_qs(urlsplit(request.target).query)
+        if 'page' not in query or self.cache is None:
+            return path
+        fmt = query.get('format', ['pdf'])[0]
+        try:
+            page = int(query['page'][0])
+        except ValueError:
+            return 400
+        if page < 1 or fmt not in FORMATS:
+            return 400
+        if not os.path.isfile(path):
+            return 404
+        name = unquote(urlsplit(request.target).path).lstrip('/')
+        if fmt == 'pdf':
+            self.prefetch(name, page)
+        try:
+            return await self.cache.get(path, page, fmt)
+        except RenderError as e:
+            print('page_path: %s page %d: %s' % (path, page, e))
+            return e.status
+
+    async def handle(self, reader, writer):
+        """Serve the requests on one connection"""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError as e:
+                    status = 431 if 'too large' in str(e) else 400
+                    await self.send_error(writer, status, False)
+                    break
+                if request is None:
+                    break
+                keep_alive = await self.respond(request, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def send_header(self, writer, status, headers, keep_alive):
+        lines = ['HTTP/1.1 %d %s' % (status, REASONS[status])]
+        headers = dict(headers)
+        headers['Date'] = formatdate(usegmt=True)
+        headers['Server'] = 'pdf_server'
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        lines.extend('%s: %s' % (k, v) for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def send_error(self, writer, status, keep_alive, headers=None):
+        body = ('%d %s\n' % (status, REASONS[status])).encode('utf-8')
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        await self.send_header(writer, status, headers, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    async def respond(self, request, writer):
+        """Respond to `request`
+            Returns: True if the connection can be used for another request
+        """
+        self.n_requests += 1
+        keep_alive = request.keep_alive()
+        if request.method not in ('GET', 'HEAD'):
+            await self.send_error(writer, 405, keep_alive, {'Allow': 'GET, HEAD'})
+            return keep_alive
+        path = resolve_path(self.root, request.target)
+        if path is None:
+            await self.send_error(writer, 403, keep_alive)
+            return keep_alive
+        path = await self.page_path(request, path)
+        if isinstance(path, int):
+            await self.send_error(writer, path, keep_alive)
+            return keep_alive
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            await self.send_error(writer, 404, keep_alive)
+            return keep_alive
+        except PermissionError:
+            await self.send_error(writer, 403, keep_alive)
+            return keep_alive
+
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            headers = {
+                'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                'Accept-Ranges': 'bytes',
+                'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+                'ETag': '"%x-%x"' % (st.st_mtime_ns, size),
+            }
+            byte_range = parse_range(request.headers.get('range'), size)
+            if_range = request.headers.get('if-range')
+            if byte_range and if_range and if_range not in (headers['ETag'], headers['Last-Modified']):
+                byte_range = None  # The file has changed. Send all of it
+            if byte_range is False:
+                await self.send_error(writer, 416, keep_alive, {'Content-Range': 'bytes */%d' % size})
+                return keep_alive
+            if byte_range:
+                start, end = byte_range
+                status = 206
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            else:
+                start, end = 0, size - 1
+                status = 200
+            count = end - start + 1
+            headers['Content-Length'] = str(count)
+            await self.send_header(writer, status, headers, keep_alive)
+            if request.method == 'GET' and count > 0:
+                loop = asyncio.get_running_loop()
+                await loop.sendfile(writer.transport, f, start, count)
+                self.n_bytes += count
+        return keep_alive
+
+
+async def serve(port=port, root=root_dir):
+    cache = PageCache(cache_dir, cache_max_bytes)
+    pdf_server = PdfServer(root, cache, load_task_pages(tasks_path))
+    server = await asyncio.start_server(pdf_server.handle, '', port, limit=max_header)
+    print('pdf_server: port=%d root=%s cache=%s %d pages %.1f MB tasks=%d' % (port,
+          pdf_server.root, cache_dir, len(cache.entries), cache.n_bytes / 1e6,
+          len(pdf_server.task_pages)))
+    async with server:
+        await server.serve_forever()
+
+
+def run(port=port, root=root_dir):
+    try:
+        asyncio.run(serve(port, root))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    run(port=int(argv[1]) if len(argv) > 1 else port,
+        root=argv[2] if len(argv) > 2 else root_dir)
@@ -0,0 +1,213 @@
+"""
+    Long lived PDFBox text extraction process
+
+    Running `java -jar pdfbox-app-2.0.7.jar ExtractText` once per PDF pays for JVM startup and
+    class loading on every file. PdfBoxDaemon keeps one JVM running PdfBoxServer.java and sends it
+    PDF paths over a pipe.
+"""
+import os
+import time
+import tempfile
+import threading
+from glob import glob
+from shutil import which, rmtree
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired, check_call
+
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SOURCE = os.path.join(MODULE_DIR, 'PdfBoxServer.java')
+SERVER_CLASS = 'PdfBoxServer'
+CLASS_DIR = os.path.join(MODULE_DIR, 'pdfbox_server_classes')
+
+
+class DaemonError(Exception):
+    """The PDFBox daemon could not be started or died while processing a file"""
+
+
+def compile_server(jar):
+    """Compile PdfBoxServer into CLASS_DIR with javac if it is missing or out of date and javac is
+        available. It is compiled in a temporary directory and the class files are moved into
+        CLASS_DIR, the main class last, so processes that compile it at the same time never see
+        a partly written class.
+        Returns: path of the main class file
+    """
+    class_path = os.path.join(CLASS_DIR, '%s.class' % SERVER_CLASS)
+    if not os.path.exists(class_path) or os.path.getmtime(class_path) < os.path.getmtime(SERVER_SOURCE):
+        if which('javac'):
+            os.makedirs(CLASS_DIR, exist_ok=True)
+            temp_dir = tempfile.mkdtemp(prefix='compile.', dir=CLASS_DIR)
+            try:
+                check_call(['javac', '-cp', jar, '-d', temp_dir, SERVER_SOURCE])
+                main = os.path.basename(class_path)
+                for name in sorted(os.listdir(temp_dir), key=lambda name: name == main):
+                    os.replace(os.path.join(temp_dir, name), os.path.join(CLASS_DIR, name))
+            finally:
+                rmtree(temp_dir, ignore_errors=True)
+    return class_path
+
+
+def server_command(jar):
+    """Return the command that runs PdfBoxServer with PDFBox `jar` on the class path.
+        The server is compiled with javac into CLASS_DIR if possible. Otherwise it is run with the
+        JDK 11+ source file launcher.
+    """
+    class_path = compile_server(jar)
+    if os.path.exists(class_path):
+        return ['java', '-cp', os.pathsep.join([jar, CLASS_DIR]), SERVER_CLASS]
+    return ['java', '-cp', jar, SERVER_SOURCE]
+
+
+class PdfBoxDaemon:
+    """A PdfBoxServer JVM that extracts HTML text from many PDFs.
+        The JVM is restarted after it crashes and after every `max_docs` PDFs. A PDF that takes
+        longer than `timeout` seconds gets the JVM killed.
+    """
+
+    def __init__(self, jar, max_docs=1000, timeout=None):
+        self.jar = jar
+        self.max_docs = max_docs
+        self.timeout = timeout
+        self.process = None
+        self.n_docs = 0
+        self.n_total = 0
+        self.n_starts = 0
+        self.broken = False
+
+    def start(self):
+        """Start the JVM and wait for PdfBoxServer to say it is ready. Sets `broken` if it can't
+            be started.
+        """
+        self.close()
+        try:
+            cmd = server_command(self.jar)
+            self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            ready = self.process.stdout.readline()
+            if ready != b'READY\n':
+                raise OSError('no READY from %s: %r' % (' '.join(cmd), ready))
+        except Exception as e:
+            self.broken = True
+            self.close()
+            raise DaemonError('could not start PdfBoxServer: %s' % e)
+        self.n_docs = 0
+        self.n_starts += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def _request(self, pdf_path):
+        """Send `pdf_path` to the server and read its response.
+            Returns: status, body
+        """
+        process = self.process
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, process.kill)
+            timer.start()
+        try:
+            process.stdin.write(('%s\n' % pdf_path).encode('utf-8'))
+            process.stdin.flush()
+            header = process.stdout.readline()
+            status, n = header.split()
+            body = process.stdout.read(int(n))
+            if len(body) != int(n):
+                raise ValueError('short read %d of %s bytes' % (len(body), n))
+        except (OSError, ValueError) as e:
+            self.close()
+            if timer and not timer.is_alive():
+                raise TimeoutExpired(['PdfBoxServer', pdf_path], self.timeout)
+            raise DaemonError('PdfBoxServer died on %s: %s' % (pdf_path, e))
+        finally:
+            if timer:
+                timer.cancel()
+        return status.decode('ascii'), body
+
+    def extract(self, pdf_path):
+        """Extract the text of PDF file `pdf_path` in html format.
+            The JVM is restarted and the request retried once if it has died.
+            Returns: ok, text (as for make_page_corpus.pdf_to_pages)
+        """
+        assert '\n' not in pdf_path, pdf_path
+        for attempt in range(2):
+            if self.process is None or self.process.poll() is not None or self.n_docs >= self.max_docs:
+                self.start()
+            try:
+                status, body = self._request(pdf_path)
+                break
+            except DaemonError:
+                if attempt:
+                    raise
+        self.n_docs += 1
+        self.n_total += 1
+        text = body.decode('utf-8')
+        if status != 'OK':
+            print('FAILURE: PdfBoxServer <%s>' % text)
+            return False, ''
+        return True, text
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def benchmark(pdf_dir, max_files=100):
+    """Compare per-file extraction latency of the one-shot `java -jar` command and PdfBoxDaemon
+        for up to `max_files` PDFs in `pdf_dir` in the 1 KB - 1 MB size band.
+    """
+    import make_page_corpus as mpc
+
+    KBYTE, MBYTE = mpc.KBYTE, mpc.MBYTE
+    bands = [(mpc.min_size, 10 * KBYTE), (10 * KBYTE, 100 * KBYTE), (100 * KBYTE, MBYTE)]
+    path_list = sorted(glob(os.path.join(pdf_dir, '**', '*.pdf'), recursive=True))
+    band_paths = {band: [] for band in bands}
+    for path in path_list:
+        size = os.path.getsize(path)
+        for lo, hi in bands:
+            if lo <= size < hi and len(band_paths[(lo, hi)]) < max_files // len(bands):
+                band_paths[(lo, hi)].append(path)
+
+    daemon = PdfBoxDaemon(mpc.PDF_BOX, timeout=mpc.file_timeout)
+    warm_up = [paths[0] for paths in band_paths.values() if paths]
+    if not warm_up:
+        print('benchmark: no PDFs in size range in %s' % pdf_dir)
+        return
+    t0 = time.perf_counter()
+    daemon.extract(warm_up[0])  # JVM startup and class loading
+    print('benchmark: daemon startup + first file %.2f sec' % (time.perf_counter() - t0))
+
+    print('%-18s %5s %22s %22s %7s' % ('size band', 'files', 'one-shot mean/p90 ms',
+                                       'daemon mean/p90 ms', 'speedup'))
+    for (lo, hi), paths in band_paths.items():
+        if not paths:
+            continue
+        one_shot, resident = [], []
+        for path in paths:
+            t0 = time.perf_counter()
+            mpc.run_command(['java', '-jar', mpc.PDF_BOX, 'ExtractText', '-html', '-console', path],
+                            raise_on_error=False, timeout=mpc.file_timeout)
+            t1 = time.perf_counter()
+            daemon.extract(path)
+            t2 = time.perf_counter()
+            one_shot.append(1000 * (t1 - t0))
+            resident.append(1000 * (t2 - t1))
+        m0 = sum(one_shot) / len(one_shot)
+        m1 = sum(resident) / len(resident)
+        print('%6dK - %6dK %5d %10.1f %10.1f %10.1f %10.1f %6.1fx' % (
+              lo // KBYTE, hi // KBYTE, len(paths), m0, percentile(one_shot, 0.9),
+              m1, percentile(resident, 0.9), m0 / max(m1, 1e-6)))
+    daemon.close()
+
+
+if __name__ == '__main__':
+    import sys
+    from utils_peter import pdf_dir
+
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else pdf_dir)
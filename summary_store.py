@@ -0,0 +1,260 @@
+"""
+    Compact storage for the PDF summaries written by make_page_corpus.py
+
+    A .psum file is
+        MAGIC
+        8 byte little endian length of the index
+        index: json {field: [offset, length, codec]}  offsets are from the end of the index
+        the fields: each one compact json, zlib compressed if codec is 'zlib'
+
+    Readers can load only the fields they need. 'page_lines' is not stored as it is
+    'page_texts' split into lines. It is rebuilt when it is asked for.
+
+    Fields of .json summaries written by utils_peter.save_json are read through a sidecar
+    <name>.json.idx file that holds the byte range of each top level field.
+"""
+import os
+import json
+import struct
+import zlib
+from glob import glob
+from utils_peter import load_json, save_json
+
+
+MAGIC = b'PSUM1\n'
+SUMMARY_EXT = '.psum'
+MIN_COMPRESS = 1024  # Fields smaller than this many bytes are not compressed
+DERIVED = {'page_lines'}
+INDEX_EXT = '.idx'
+CHUNK_SIZE = 1024 * 1024
+# save_json writes each top level key at the start of a line indented by 4 spaces. A raw newline
+# can't occur inside a json string so this only matches top level keys.
+KEY_MARKER = b'\n    "'
+
+
+def is_compact(path):
+    return path.endswith(SUMMARY_EXT)
+
+
+def save_compact(path, summary, compress=True):
+    """Save dict `summary` to `path` in .psum format"""
+    blobs = []
+    index = {}
+    offset = 0
+    for field in sorted(summary):
+        if field in DERIVED:
+            continue
+        data = json.dumps(summary[field], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        codec = 'json'
+        if compress and len(data) >= MIN_COMPRESS:
+            data = zlib.compress(data, 6)
+            codec = 'zlib'
+        index[field] = [offset, len(data), codec]
+        blobs.append(data)
+        offset += len(data)
+    header = json.dumps(index, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+    temp_path = '%s.tmp' % path
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for data in blobs:
+            f.write(data)
+    os.replace(temp_path, path)
+
+
+def read_index(f):
+    """Read the index of .psum file `f`
+        Returns: index, offset of the field data in the file
+    """
+    magic = f.read(len(MAGIC))
+    assert magic == MAGIC, (f.name, magic)
+    n, = struct.unpack('<Q', f.read(8))
+    index = json.loads(f.read(n).decode('utf-8'))
+    return index, len(MAGIC) + 8 + n
+
+
+def load_compact(path, fields=None):
+    """Load the fields in `fields` (all fields if None) from .psum file `path`
+        Returns: dict of the fields that are in the file
+    """
+    summary = {}
+    with open(path, 'rb') as f:
+        index, base = read_index(f)
+        if fields is None:
+            fields = list(index) + sorted(DERIVED)
+        wanted = set(fields)
+        if wanted & DERIVED:
+            wanted.add('page_texts')
+        for field in sorted(wanted & set(index), key=lambda k: index[k][0]):
+            offset, length, codec = index[field]
+            f.seek(base + offset)
+            data = f.read(length)
+            if codec == 'zlib':
+                data = zlib.decompress(data)
+            summary[field] = json.loads(data.decode('utf-8'))
+    if 'page_lines' in fields and 'page_texts' in summary:
+        summary['page_lines'] = [text.split('\n') for text in summary['page_texts']]
+        if 'page_texts' not in fields:
+            del summary['page_texts']
+    return summary
+
+
+def scan_json_index(path):
+    """Find the byte range of each top level field of json file `path` written by save_json,
+        reading it in CHUNK_SIZE pieces.
+        Returns: {field: [start, end]} or None if `path` is not in save_json's format
+    """
+    size = os.path.getsize(path)
+    markers = []
+    with open(path, 'rb') as f:
+        if f.read(len(KEY_MARKER) + 1) != b'{' + KEY_MARKER:
+            return None
+        markers.append(1)
+        pos = 0
+        tail = b''
+        while True:
+            f.seek(pos)
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            data = tail + chunk
+            base = pos - len(tail)
+            i = data.find(KEY_MARKER, 1 if base == 0 else 0)
+            while i >= 0:
+                if base + i > markers[-1]:
+                    markers.append(base + i)
+                i = data.find(KEY_MARKER, i + 1)
+            tail = data[-(len(KEY_MARKER) - 1):]
+            pos += len(chunk)
+
+        f.seek(size - 2)
+        if f.read(2) != b'\n}':
+            return None
+
+        index = {}
+        for j, marker in enumerate(markers):
+            f.seek(marker + len(KEY_MARKER) - 1)
+            head = f.read(512)
+            k = head.find(b'": ')
+            if k < 0:
+                return None
+            field = json.loads(head[:k + 1].decode('utf-8'))
+            start = marker + len(KEY_MARKER) - 1 + k + 3
+            end = markers[j + 1] - 1 if j + 1 < len(markers) else size - 2
+            index[field] = [start, end]
+    return index
+
+
+def json_index(path):
+    """Return the field index of json summary `path` from its sidecar file, building the sidecar
+        if it is missing or out of date.
+        Returns: {field: [start, end]} or None if `path` can't be indexed
+    """
+    st = os.stat(path)
+    index_path = '%s%s' % (path, INDEX_EXT)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                sidecar = json.load(f)
+            if sidecar['size'] == st.st_size and sidecar['mtime_ns'] == st.st_mtime_ns:
+                return sidecar['fields']
+        except (ValueError, KeyError):
+            pass
+    index = scan_json_index(path)
+    if index is not None:
+        try:
+            with open(index_path, 'w') as f:
+                json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'fields': index}, f)
+        except OSError:
+            pass  # Read-only summary directory. Use the index without saving it
+    return index
+
+
+def load_json_fields(path, fields):
+    """Load `fields` of json summary `path`, reading only their bytes when it can be indexed
+        Returns: dict of the requested fields that are in the summary
+    """
+    index = json_index(path)
+    if index is None:
+        summary = load_json(path)
+        return {field: summary[field] for field in fields if field in summary}
+    summary = {}
+    with open(path, 'rb') as f:
+        for field in fields:
+            if field not in index:
+                continue
+            start, end = index[field]
+            f.seek(start)
+            summary[field] = json.loads(f.read(end - start).decode('utf-8'))
+    return summary
+
+
+def save_summary(path, summary):
+    """Save `summary` to `path` in the format given by the file extension"""
+    if is_compact(path):
+        save_compact(path, summary)
+    else:
+        temp_path = '%s.tmp' % path
+        save_json(temp_path, summary)
+        os.replace(temp_path, path)
+
+
+def load_summary(path, fields=None):
+    """Load `fields` (all if None) of the summary in `path`, which may be .json or .psum
+        Returns: dict of the requested fields that are in the summary
+    """
+    if is_compact(path):
+        return load_compact(path, fields)
+    if fields is None:
+        return load_json(path)
+    return load_json_fields(path, fields)
+
+
+def summary_paths(root):
+    """Return the paths of the summaries in directory `root`. If a summary is stored as both .json
+        and .psum, only the .psum is returned.
+    """
+    compact = glob(os.path.join(root, '*%s' % SUMMARY_EXT))
+    names = {os.path.splitext(path)[0] for path in compact}
+    path_list = compact + [path for path in glob(os.path.join(root, '*.json'))
+                           if os.path.splitext(path)[0] not in names]
+    return sorted(path_list)
+
+
+def convert_json(json_path, remove=False):
+    """Convert summary `json_path` to .psum format
+        Returns: path of the .psum file
+    """
+    path = '%s%s' % (os.path.splitext(json_path)[0], SUMMARY_EXT)
+    summary = load_json(json_path)
+    summary.pop('text', None)  # Older summaries also stored the whole document
+    save_compact(path, summary)
+    if remove:
+        os.remove(json_path)
+    return path
+
+
+def convert_dir(root, remove=False):
+    """Convert all the .json summaries in directory `root` to .psum format"""
+    n_json = n_compact = 0
+    path_list = sorted(glob(os.path.join(root, '*.json')))
+    for i, json_path in enumerate(path_list):
+        n0 = os.path.getsize(json_path)
+        path = convert_json(json_path, remove=remove)
+        n1 = os.path.getsize(path)
+        n_json += n0
+        n_compact += n1
+        print('%4d of %d: %s %.1f -> %.1f KB' % (i, len(path_list), json_path, n0 / 1024, n1 / 1024))
+    if n_json:
+        print('convert_dir: %d files %.1f MB -> %.1f MB (%.1f%%)' % (len(path_list), n_json / 1e6,
+              n_compact / 1e6, 100.0 * n_compact / n_json))
+
+
+if __name__ == '__main__':
+    import sys
+    from utils_peter import summary_dir
+
+    args = [arg for arg in sys.argv[1:] if arg != '--remove']
+    convert_dir(args[0] if args else summary_dir, remove='--remove' in sys.argv)
@@ -5,31 +5,88 @@
            },
     }
 """
-from glob import glob
+import heapq
+import jsonlines
+from collections import defaultdict
 from os.path import join, relpath
-from utils_peter import pdf_dir, summary_dir, save_jsonl, load_json
+from tempfile import TemporaryDirectory
+from utils_peter import pdf_dir, summary_dir, save_jsonl
+from summary_store import load_summary, summary_paths
+
+
+SUMMARY_FIELDS = ['path', 'page_texts', 'marked_text', 'marked_graph']
+max_text_len = 100       # Longest page text that is sent to Prodigy
+max_entries = 1000000    # Most entries sorted in memory. More are merge sorted via temp files
+page_urls = False        # Link tasks to one page renders from pdf_server.py rather than whole PDFs
 
 
 def save_pages(summary_dir):
-    path_list = list(glob(join(summary_dir, '*.json')))
-    print('path_list=%d' % len(path_list))
-    summary_list = [load_json(path) for path in path_list]
-    print('summary_list=%d' % len(summary_list))
-    summary_list = [summary for summary in summary_list if 'path' in summary]
-    print('summary_list=%d' % len(summary_list))
-    entry_list = []
-    for summary in summary_list:
-        # if 'path' not in summary:
-        #     continue
-        assert 'path' in summary, sorted(summary)
-        entry_list.extend(summary_to_entries(summary))
-    print('entry_list=%d' % len(entry_list))
-    entry_list = [entry for entry in entry_list if len(entry[2]) <= 100]
-    print('entry_list=%d' % len(entry_list))
-    entry_list.sort(key=entry_key)
-    prodigy_list = [to_prodigy(*entry) for entry in entry_list]
-    print('prodigy_list=%d' % len(prodigy_list))
+    """Write the Prodigy tasks for the text only pages of the summaries in `summary_dir` to
+        all.pages.jsonl in entry_key order. Summaries are read one at a time and the tasks are
+        written as they are generated, so memory use doesn't grow with the corpus.
+    """
+    counts = defaultdict(int)
+    entries = iter_entries(summary_paths(summary_dir), counts)
+    prodigy_list = (to_prodigy(*entry) for entry in sorted_entries(entries, max_entries, counts))
     save_jsonl('all.pages.jsonl', prodigy_list)
+    print('path_list=%d summary_list=%d entry_list=%d prodigy_list=%d runs=%d' % (
+          counts['paths'], counts['summaries'], counts['entries'], counts['kept'], counts['runs']))
+
+
+def iter_entries(path_list, counts):
+    """Generate the (name, page, text) entries of the summaries in `path_list` with texts no longer
+        than `max_text_len`.
+    """
+    for path in path_list:
+        counts['paths'] += 1
+        summary = load_summary(path, SUMMARY_FIELDS)
+        if 'path' not in summary:
+            continue
+        counts['summaries'] += 1
+        for entry in summary_to_entries(summary):
+            counts['entries'] += 1
+            if len(entry[2]) <= max_text_len:
+                counts['kept'] += 1
+                yield entry
+
+
+def save_run(run_dir, run, counts):
+    """Sort `run` and save it to a file in `run_dir`
+        Returns: path of file
+    """
+    run.sort(key=entry_key)
+    path = join(run_dir, 'run%05d.jsonl' % counts['runs'])
+    save_jsonl(path, run)
+    counts['runs'] += 1
+    return path
+
+
+def load_run(path):
+    with jsonlines.open(path, mode='r') as r:
+        for name, page, text in r:
+            yield name, page, text
+
+
+def sorted_entries(entries, max_entries, counts):
+    """Generate `entries` in entry_key order. Up to `max_entries` are sorted in memory. Larger
+        inputs are sorted in runs of `max_entries` that are saved to temporary files and merged.
+    """
+    run = []
+    run_paths = []
+    with TemporaryDirectory(prefix='to_prodigy.') as run_dir:
+        for entry in entries:
+            run.append(entry)
+            if len(run) >= max_entries:
+                run_paths.append(save_run(run_dir, run, counts))
+                run = []
+        if not run_paths:
+            run.sort(key=entry_key)
+            yield from run
+            return
+        if run:
+            run_paths.append(save_run(run_dir, run, counts))
+            run = []
+        yield from heapq.merge(*[load_run(path) for path in run_paths], key=entry_key)
 
 
 def entry_key(entry):
@@ -67,7 +124,10 @@ def to_prodigy(path, page, text):
         }
     """
     name = relpath(path, pdf_dir)
-    url = 'http://localhost:8000/%s#page=%d' % (name, page)
+    if page_urls:
+        url = 'http://localhost:8000/%s?page=%d' % (name, page)
+    else:
+        url = 'http://localhost:8000/%s#page=%d' % (name, page)
 
     return {
         'text': text,
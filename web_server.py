@@ -20,9 +20,14 @@ from socketserver import TCPServer
 from urllib.parse import unquote
 import os
 from glob import glob
-from time import clock
+from time import perf_counter
 from collections import defaultdict
+from functools import partial
+from multiprocessing import Pool, SimpleQueue
+from multiprocessing.util import Finalize
 import shutil
+import tempfile
+import traceback
 from neuroner import NeuroNER
 from make_text_corpus import pdftotext, dehyphenate
 from brat_to_conll import get_entities_from_brat
@@ -33,11 +38,13 @@ dataset_root = '/Users/pcadmin/phi.data'
 dataset_text_folder = os.path.join(dataset_root, 'deploy')
 dataset_text_folder_pdf = '/Users/pcadmin/phi.data.pdf'
 output_folder = '/Users/pcadmin/phi.output'
-path_txt = os.path.join(dataset_text_folder, 'text.txt')
 parameters_filepath = 'parameters_phi_data.ini'
+n_models = 2  # Warm NeuroNER models in a ModelPool, one per worker process
 
-shutil.rmtree(dataset_root)
-os.makedirs(dataset_text_folder, exist_ok=True)
+
+def reset_dataset():
+    shutil.rmtree(dataset_root, ignore_errors=True)
+    os.makedirs(dataset_text_folder, exist_ok=True)
 
 
 def abridge(text, maxlen=200):
@@ -113,12 +120,17 @@ def summarize(entities, max_texts=5):
 
 
 def predict(nn, path, maxlen=None):
+    """Find the entities in PDF file `path` with NeuroNER model `nn`
+        The text is extracted to a temporary file that is private to this call.
+        Returns: text, entities, [t0, t1, t2]
+            t0: start, t1: text extracted, t2: entities predicted
     """
-    """
-    t0 = clock()
+    t0 = perf_counter()
     try:
-        pdftotext(path, path_txt)
-        text = read_file(path_txt)
+        with tempfile.TemporaryDirectory(prefix='predict.') as temp_dir:
+            txt_path = os.path.join(temp_dir, 'text.txt')
+            pdftotext(path, txt_path)
+            text = read_file(txt_path)
         text = dehyphenate(text)
     except:
         return '', [], [t0, t0, t0]
@@ -131,34 +143,98 @@ def predict(nn, path, maxlen=None):
     if not text:
         return '', [], [t0, t0, t0]
 
-    t1 = clock()
+    t1 = perf_counter()
     entities = nn.predict(text)
-    t2 = clock()
+    t2 = perf_counter()
     return text, entities, [t0, t1, t2]
 
 
-def predict_list(path_list, maxlen=None):
+worker_nn = None  # The NeuroNER model of a ModelPool worker process
+
+
+def init_worker(loaded):
+    """Load the NeuroNER model of a ModelPool worker process then put (pid, None) on queue
+        `loaded`, or (pid, traceback) if the model could not be loaded.
+        Each model gets its own dataset and output folders so that models don't overwrite each
+        other's files. The model is closed when the worker exits.
     """
+    global worker_nn
+    name = 'worker_%d' % os.getpid()
+    worker_text_folder = os.path.join(dataset_root, name)
+    worker_output_folder = os.path.join(output_folder, name)
+    try:
+        os.makedirs(os.path.join(worker_text_folder, 'deploy'), exist_ok=True)
+        os.makedirs(worker_output_folder, exist_ok=True)
+        worker_nn = NeuroNER(parameters_filepath=parameters_filepath,
+                             dataset_text_folder=worker_text_folder,
+                             output_folder=worker_output_folder)
+        Finalize(worker_nn, worker_nn.close, exitpriority=10)
+        worker_nn.predict('Warm up.')  # The first prediction sets up the model's deploy folders
+    except BaseException:
+        loaded.put((os.getpid(), traceback.format_exc()))
+        raise
+    loaded.put((os.getpid(), None))
+
+
+def predict_task(path, maxlen):
+    return predict(worker_nn, path, maxlen)
+
+
+class ModelPool:
+    """`n_models` warm NeuroNER models, each in its own process so that they don't share
+        TensorFlow state. The models are loaded when the pool is created. predict() may be
+        called from several threads at once.
+        Raises: RuntimeError if a model can't be loaded
+    """
+
+    def __init__(self, n_models=n_models):
+        self.n_models = n_models
+        loaded = SimpleQueue()
+        self.pool = Pool(n_models, initializer=init_worker, initargs=(loaded,))
+        for _ in range(n_models):
+            pid, error = loaded.get()
+            if error is not None:
+                # Pool would keep replacing the worker and failing to load the model
+                self.pool.terminate()
+                raise RuntimeError('NeuroNER model failed to load in process %d\n%s' % (pid, error))
+
+    def predict(self, path, maxlen=None):
+        """Returns: predict(`path`, `maxlen`) run by the next free model"""
+        return self.pool.apply_async(predict_task, (path, maxlen)).get()
+
+    def predict_all(self, path_list, maxlen=None):
+        """Generate predict() results for the files in `path_list` in order"""
+        return self.pool.imap(partial(predict_task, maxlen=maxlen), path_list)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def predict_list(path_list, maxlen=None, models=None):
+    """Run predict() on the files in `path_list` using ModelPool `models`, which is created for
+        this call if it is None, and print the entities and timings.
     """
     os.makedirs(dataset_text_folder, exist_ok=True)
     files = list(glob(os.path.join(dataset_text_folder, '*')))
     print('files=%d %s' % (len(files), files))
     # assert files
-    nn = NeuroNER(parameters_filepath=parameters_filepath)
+    pool = models or ModelPool()
     results = {}
     try:
-        for i, path in enumerate(path_list):
+        for i, (path, result) in enumerate(zip(path_list, pool.predict_all(path_list, maxlen))):
             print('~' * 80)
-            print('Processing %d of %d' % (i, len(path_list)), end=': ')
-            text, entities, times = predict(nn, path)
-            results[path] = (text, entities, times)
+            print('Processed %d of %d' % (i, len(path_list)))
+            results[path] = result
     except Exception as e:
         print('^' * 80)
-        print('Failed to process %s' % path)
+        print('Failed to process %s' % path_list[len(results)])
         print(type(e))
         print(e)
         raise
-    nn.close()
+    finally:
+        if models is None:
+            pool.close()
     print('=' * 80)
     print('Completed %d of %d' % (len(results), len(path_list)))
 
@@ -204,7 +280,9 @@ if False:
     markup_dir('/Users/pcadmin/phi.output/good_2017-10-17_09-48-14-196551/brat/deploy/',
                '/Users/pcadmin/phi.http')
     assert False
-if True:
+
+
+def serve_html():
     cwd = os.getcwd()
     print('^' * 80)
     print('cwd=%s' % cwd)
@@ -277,6 +355,8 @@ def run(port=9999):
 if __name__ == "__main__":
     from sys import argv
 
+    reset_dataset()
+    serve_html()
     if len(argv) == 2:
         run(port=int(argv[1]))
     else: